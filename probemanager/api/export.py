@@ -0,0 +1,89 @@
+"""
+Export of a queryset in a streamed response, in NDJSON or CSV, compressed with gzip on demand.
+The rows are read with a server-side cursor, EXPORT_CHUNK_SIZE rows at a time.
+"""
+import csv
+import json
+import zlib
+from datetime import date, datetime
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# Size of the chunks sent, in characters
+BUFFER_SIZE = 65536
+
+
+class Echo:
+    """
+    File-like object for csv.writer, returns the line instead of writing it.
+    """
+    def write(self, value):
+        return value
+
+
+def to_text(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def ndjson_lines(rows, fields):
+    for values in rows:
+        yield json.dumps({field: to_text(values[field]) for field in fields}, cls=DjangoJSONEncoder) + '\n'
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for values in rows:
+        yield writer.writerow([to_text(values[field]) for field in fields])
+
+
+def buffered(lines):
+    buffer = list()
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = list()
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(request, queryset, fields, name):
+    """
+    Streams the fields of the rows of the queryset. Parameters of the request : output (ndjson or csv)
+    and compression (gzip).
+    """
+    output = request.query_params.get('output', 'ndjson')
+    if output not in CONTENT_TYPES:
+        raise ValidationError({'output': 'Unknown output : ' + output + ', ndjson or csv'})
+    compression = request.query_params.get('compression')
+    if compression not in (None, '', 'gzip'):
+        raise ValidationError({'compression': 'Unknown compression : ' + compression + ', gzip'})
+    rows = queryset.values(*fields).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    lines = ndjson_lines(rows, fields) if output == 'ndjson' else csv_lines(rows, fields)
+    file_name = name + '.' + output
+    if compression:
+        response = StreamingHttpResponse(gzip_chunks(buffered(lines)), content_type='application/gzip')
+        file_name += '.gz'
+    else:
+        response = StreamingHttpResponse(buffered(lines), content_type=CONTENT_TYPES[output] + '; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="' + file_name + '"'
+    return response
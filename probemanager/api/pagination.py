@@ -1,6 +1,16 @@
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
 
 
 class StandardResultsSetPagination(LimitOffsetPagination):
     default_limit = 20
     max_limit = 100
+
+
+class JobCursorPagination(CursorPagination):
+    """
+    Pages of the jobs from the newest, a page starts after the last job of the previous page instead of an OFFSET.
+    """
+    ordering = ('-created', '-id')
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
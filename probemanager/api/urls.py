@@ -15,6 +15,7 @@ router.register(r'^core/server', views.ServerViewSet, base_name="core")
 router.register(r'^core/sshkey', views.SshKeyViewSet, base_name="core")
 router.register(r'^core/configuration', views.ConfigurationViewSet, base_name="core")
 router.register(r'^core/job', views.JobViewSet, base_name="core")
+router.register(r'^core/probehealthsample', views.ProbeHealthSampleViewSet, base_name="core")
 router.register(r'^celerybeat/crontabschedule', views.CrontabScheduleViewSet)
 router.register(r'^celerybeat/periodictask', views.PeriodicTaskViewSet)
 
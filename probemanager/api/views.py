@@ -2,14 +2,20 @@ import os
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
 from rest_framework import mixins
 from rest_framework import status
 from rest_framework import viewsets
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 
-from core.models import Server, SshKey, Configuration, Job
+from core.models import Server, SshKey, Configuration, Job, ProbeHealthSample
+from core.ssh import fan_out
+from .export import export_response
+from .pagination import JobCursorPagination
 from .serializers import UserSerializer, GroupSerializer, CrontabScheduleSerializer, \
     PeriodicTaskSerializer, ServerSerializer, SshKeySerializer, ConfigurationSerializer, \
     ConfigurationUpdateSerializer, JobSerializer
@@ -54,6 +60,21 @@ class ServerViewSet(viewsets.ModelViewSet):
             response = obj.test()
         return Response(response)
 
+    @action(detail=False)
+    def test_connections(self, request):
+        def test(server):
+            if server.become:
+                return server.test_become()
+            else:
+                return server.test()
+        response = dict()
+        for server, result in fan_out(self.get_queryset().select_related('ssh_private_key_file'), test):
+            if result['status']:
+                response[server.name] = result['result']
+            else:
+                response[server.name] = result
+        return Response(response)
+
 
 class ConfigurationViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     queryset = Configuration.objects.all()
@@ -86,5 +107,82 @@ class SshKeyViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.Des
 
 
 class JobViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Filters : name, probe, status, created_after and created_before (ISO 8601).
+    fields : comma separated fields in the response, example fields=id,name,status. The result is not read
+    from the database when it is not in the fields.
+    """
     queryset = Job.objects.all()
     serializer_class = JobSerializer
+    pagination_class = JobCursorPagination
+
+    def get_fields(self):
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = set(fields) - set(JobSerializer().fields)
+        if unknown:
+            raise ValidationError({'fields': 'Unknown fields : ' + ', '.join(sorted(unknown))})
+        return fields
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        for name in ('name', 'probe', 'status'):
+            if params.get(name):
+                queryset = queryset.filter(**{name: params[name]})
+        for name, lookup in (('created_after', 'created__gte'), ('created_before', 'created__lt')):
+            if params.get(name):
+                try:
+                    value = parse_datetime(params[name])
+                except ValueError:
+                    value = None
+                if value is None:
+                    raise ValidationError({name: 'Invalid date : ' + params[name]})
+                queryset = queryset.filter(**{lookup: value})
+        fields = self.get_fields()
+        if fields is not None and 'result' not in fields:
+            queryset = queryset.defer('result')
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.get_fields()
+        return super().get_serializer(*args, **kwargs)
+
+    @action(detail=False)
+    def export(self, request):
+        """
+        All the jobs matching the filters, from the oldest, see export_response() for the parameters.
+        """
+        fields = self.get_fields() or [field.attname for field in Job._meta.concrete_fields]
+        return export_response(request, self.get_queryset().order_by('created', 'id'), fields, 'jobs')
+
+
+class ProbeHealthSampleViewSet(viewsets.GenericViewSet):
+    """
+    Filters : probe (name), since and until (ISO 8601).
+    """
+    queryset = ProbeHealthSample.objects.all()
+    fields = ('id', 'probe_name', 'timestamp', 'state', 'uptime', 'latency')
+
+    def get_queryset(self):
+        queryset = super().get_queryset().annotate(probe_name=F('probe__name'))
+        params = self.request.query_params
+        if params.get('probe'):
+            queryset = queryset.filter(probe__name=params['probe'])
+        for name, lookup in (('since', 'timestamp__gte'), ('until', 'timestamp__lt')):
+            if params.get(name):
+                try:
+                    value = parse_datetime(params[name])
+                except ValueError:
+                    value = None
+                if value is None:
+                    raise ValidationError({name: 'Invalid date : ' + params[name]})
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
+
+    @action(detail=False)
+    def export(self, request):
+        return export_response(request, self.get_queryset().order_by('timestamp', 'id'), self.fields,
+                               'probe_health')
@@ -5,7 +5,7 @@ from django.contrib import messages
 from django_celery_beat.models import SolarSchedule, IntervalSchedule
 
 from .forms import ServerForm
-from .models import SshKey, Server, Job, Configuration
+from .models import SshKey, Server, Job, Configuration, TransferStatistic, SshCircuit, ProbeHealthSample
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +27,7 @@ class ServerAdmin(admin.ModelAdmin):
 
 class JobAdmin(admin.ModelAdmin):
     list_filter = ('status', 'completed', 'probe')
-    list_display = ('name', 'probe', 'status', 'created', 'completed', 'result')
+    list_display = ('name', 'probe', 'status', 'created', 'completed', 'attempts', 'result')
     list_display_links = None
 
     class Media:
@@ -39,10 +39,40 @@ class JobAdmin(admin.ModelAdmin):
         return False
 
 
+class TransferStatisticAdmin(admin.ModelAdmin):
+    list_filter = ('server', 'method', 'compression', 'cipher')
+    list_display = ('server', 'dest', 'method', 'size', 'sent', 'duration', 'throughput', 'compression', 'cipher',
+                    'created')
+    list_display_links = None
+
+    def has_add_permission(self, request):
+        return False
+
+
+class SshCircuitAdmin(admin.ModelAdmin):
+    list_display = ('server', 'failures', 'opened_until')
+    list_display_links = None
+
+    def has_add_permission(self, request):
+        return False
+
+
+class ProbeHealthSampleAdmin(admin.ModelAdmin):
+    list_filter = ('probe', 'state')
+    list_display = ('probe', 'timestamp', 'state', 'uptime', 'latency')
+    list_display_links = None
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(SshKey)
 admin.site.register(Server, ServerAdmin)
 admin.site.register(Job, JobAdmin)
 admin.site.register(Configuration)
+admin.site.register(TransferStatistic, TransferStatisticAdmin)
+admin.site.register(SshCircuit, SshCircuitAdmin)
+admin.site.register(ProbeHealthSample, ProbeHealthSampleAdmin)
 
 admin.site.unregister(SolarSchedule)
 admin.site.unregister(IntervalSchedule)
@@ -0,0 +1,130 @@
+"""
+Archive of the old jobs : one gzip file per day of creation, a JSON job per line (NDJSON).
+"""
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('id', 'name', 'probe', 'status', 'result', 'created', 'completed', 'attempts')
+DATE_FIELDS = ('created', 'completed')
+
+
+def archive_path(day):
+    return os.path.join(settings.JOB_ARCHIVE_DIR, 'jobs-' + day.isoformat() + '.ndjson.gz')
+
+
+def archive_days():
+    """
+    Returns the days with an archive file, sorted.
+    """
+    if not os.path.isdir(settings.JOB_ARCHIVE_DIR):
+        return []
+    days = list()
+    for file_name in os.listdir(settings.JOB_ARCHIVE_DIR):
+        if file_name.startswith('jobs-') and file_name.endswith('.ndjson.gz'):
+            try:
+                days.append(datetime.strptime(file_name[5:-10], '%Y-%m-%d').date())
+            except ValueError:
+                logger.warning('Not an archive of jobs : ' + file_name)
+    return sorted(days)
+
+
+def job_to_dict(values):
+    return {field: values[field].isoformat() if field in DATE_FIELDS and values[field] else values[field]
+            for field in FIELDS}
+
+
+def dict_to_job(values):
+    values = dict(values)
+    for field in DATE_FIELDS:
+        if values.get(field):
+            values[field] = parse_datetime(values[field])
+    return Job(**{field: values.get(field) for field in FIELDS if field in values})
+
+
+def archive_jobs(retention_days=None, batch_size=None):
+    """
+    Moves the finished jobs older than retention_days (JOB_RETENTION_DAYS) into the archive files,
+    batch_size (JOB_ARCHIVE_BATCH_SIZE) jobs at a time : the jobs of a batch are deleted once written.
+    A gzip file can have several members, a day archived twice is appended. Returns the number of jobs archived.
+    """
+    if retention_days is None:
+        retention_days = settings.JOB_RETENTION_DAYS
+    if batch_size is None:
+        batch_size = settings.JOB_ARCHIVE_BATCH_SIZE
+    os.makedirs(settings.JOB_ARCHIVE_DIR, exist_ok=True)
+    limit = timezone.now() - timedelta(days=retention_days)
+    queryset = Job.objects.filter(created__lt=limit).exclude(status='In progress').order_by('created', 'id')
+    archived = 0
+    while True:
+        batch = list(queryset.values(*FIELDS)[:batch_size])
+        if not batch:
+            return archived
+        days = dict()
+        for values in batch:
+            days.setdefault(timezone.localdate(values['created']), []).append(values)
+        for day, jobs in days.items():
+            with gzip.open(archive_path(day), 'at', encoding='utf-8') as archive:
+                for values in jobs:
+                    archive.write(json.dumps(job_to_dict(values), sort_keys=True) + '\n')
+        with transaction.atomic():
+            Job.objects.filter(id__in=[values['id'] for values in batch]).delete()
+        archived += len(batch)
+        logger.info(str(archived) + " jobs archived")
+
+
+def read_archives(start=None, end=None, name=None, probe=None, status=None):
+    """
+    Iterates over the archived jobs (dict) created between the dates start and end included, with this name,
+    probe and status. Reads the archive files one line at a time.
+    """
+    for day in archive_days():
+        if (start and day < start) or (end and day > end):
+            continue
+        with gzip.open(archive_path(day), 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                values = json.loads(line)
+                if (name is None or values['name'] == name) and (probe is None or values['probe'] == probe) and \
+                        (status is None or values['status'] == status):
+                    yield values
+
+
+def restore_jobs(start=None, end=None, name=None, probe=None, status=None, batch_size=None):
+    """
+    Restores in the database the archived jobs matching the filters of read_archives(), except the jobs
+    already in the database. The archive files are kept. Returns the number of jobs restored.
+    """
+    if batch_size is None:
+        batch_size = settings.JOB_ARCHIVE_BATCH_SIZE
+    restored = 0
+    batch = list()
+    for values in read_archives(start=start, end=end, name=name, probe=probe, status=status):
+        batch.append(values)
+        if len(batch) >= batch_size:
+            restored += restore_batch(batch)
+            batch = list()
+    if batch:
+        restored += restore_batch(batch)
+    return restored
+
+
+def restore_batch(batch):
+    existing = set(Job.objects.filter(id__in=[values['id'] for values in batch]).values_list('id', flat=True))
+    jobs = dict()
+    for values in batch:
+        # A job archived twice (interrupted archiving) is restored once.
+        if values['id'] not in existing:
+            jobs[values['id']] = dict_to_job(values)
+    Job.objects.bulk_create(jobs.values())
+    return len(jobs)
@@ -0,0 +1,200 @@
+"""
+Block-level delta transfer, like rsync.
+
+The remote server computes the signature of its version of the file : a weak rolling checksum (adler32)
+and a strong hash for each block. Locally, the new file is scanned to find these blocks at any offset,
+and only the bytes not found remotely are sent.
+The remote server rebuilds the file from its blocks and the delta, and checks the sha256 of the result.
+"""
+import hashlib
+import json
+import math
+import shlex
+import struct
+import zlib
+
+BLOCK_SIZE_MIN = 2048
+BLOCK_SIZE_MAX = 65536
+# Above this part of the file not found remotely, the delta is abandoned : the scan byte per byte of the
+# changed parts is slower than the full copy.
+MAX_LITERAL_RATIO = 0.25
+ADLER_MOD = 65521
+
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+
+# Executed on the remote server with 'python3 -c', must stay identical with the local functions.
+REMOTE_HELPER = """
+import hashlib, json, os, struct, sys, zlib
+
+
+def weak_checksum(block):
+    return zlib.adler32(block)
+
+
+def strong_checksum(block):
+    return hashlib.md5(block).hexdigest()[:16]
+
+
+def signature(path, block_size):
+    sums = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+            sums.append([weak_checksum(block), strong_checksum(block)])
+    sys.stdout.write(json.dumps(sums))
+
+
+def patch(path, delta_path, block_size, sha256):
+    tmp = path + '.pm-delta'
+    digest = hashlib.sha256()
+    with open(path, 'rb') as old, open(delta_path, 'rb') as delta, open(tmp, 'wb') as new:
+        while True:
+            op = delta.read(1)
+            if not op:
+                break
+            if op == b'C':
+                start, count = struct.unpack('>II', delta.read(8))
+                old.seek(start * block_size)
+                for i in range(count):
+                    data = old.read(block_size)
+                    digest.update(data)
+                    new.write(data)
+            else:
+                length, = struct.unpack('>I', delta.read(4))
+                data = delta.read(length)
+                digest.update(data)
+                new.write(data)
+    os.remove(delta_path)
+    if digest.hexdigest() != sha256:
+        os.remove(tmp)
+        sys.exit('Checksum mismatch after patch')
+    stat = os.stat(path)
+    os.chmod(tmp, stat.st_mode)
+    try:
+        os.chown(tmp, stat.st_uid, stat.st_gid)
+    except OSError:
+        pass
+    os.rename(tmp, path)
+
+
+if sys.argv[1] == 'signature':
+    signature(sys.argv[2], int(sys.argv[3]))
+else:
+    patch(sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5])
+"""
+
+
+def block_size_for(size):
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(BLOCK_SIZE_MIN, min(BLOCK_SIZE_MAX, block_size))
+
+
+def weak_checksum(block):
+    return zlib.adler32(block)
+
+
+def strong_checksum(block):
+    return hashlib.md5(block).hexdigest()[:16]
+
+
+def signature_command(path, block_size):
+    return "python3 -c " + shlex.quote(REMOTE_HELPER) + " signature " + shlex.quote(path) + " " + str(block_size)
+
+
+def patch_command(path, delta_path, block_size, sha256):
+    return "python3 -c " + shlex.quote(REMOTE_HELPER) + " patch " + shlex.quote(path) + " " + \
+           shlex.quote(delta_path) + " " + str(block_size) + " " + sha256
+
+
+def parse_signature(output):
+    """
+    Returns a dict weak checksum -> {strong checksum: block index}.
+    """
+    table = dict()
+    for index, (weak, strong) in enumerate(json.loads(output)):
+        table.setdefault(weak, dict()).setdefault(strong, index)
+    return table
+
+
+class DeltaWriter:
+    """
+    Writes the delta operations, merges the consecutive blocks and the consecutive literals.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_bytes = 0
+        self.copied_blocks = 0
+
+    def flush_copy(self):
+        if self.copy_count:
+            self.f.write(OP_COPY + struct.pack('>II', self.copy_start, self.copy_count))
+            self.copied_blocks += self.copy_count
+            self.copy_start = None
+            self.copy_count = 0
+
+    def copy(self, index):
+        if self.copy_count and self.copy_start + self.copy_count == index:
+            self.copy_count += 1
+        else:
+            self.flush_copy()
+            self.copy_start = index
+            self.copy_count = 1
+
+    def literal(self, data):
+        if data:
+            self.flush_copy()
+            self.f.write(OP_LITERAL + struct.pack('>I', len(data)) + data)
+            self.literal_bytes += len(data)
+
+    def close(self):
+        self.flush_copy()
+
+
+def compute_delta(data, table, block_size, f):
+    """
+    Writes in f the delta to rebuild data from the remote blocks described by table.
+    Returns the number of literal bytes sent, None if more than MAX_LITERAL_RATIO of data is not found remotely.
+    The blocks following a match are checked whole with zlib.adler32, the checksum rolls byte per byte
+    in Python only through the changed parts, until the next match.
+    """
+    writer = DeltaWriter(f)
+    size = len(data)
+    max_literal = int(size * MAX_LITERAL_RATIO)
+    position = 0
+    literal_start = 0
+    aligned = True
+    while position + block_size <= size:
+        if aligned:
+            weak = zlib.adler32(data[position:position + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+        else:
+            weak = a | (b << 16)
+        candidates = table.get(weak)
+        if candidates:
+            index = candidates.get(strong_checksum(data[position:position + block_size]))
+            if index is not None:
+                writer.literal(data[literal_start:position])
+                writer.copy(index)
+                position += block_size
+                literal_start = position
+                aligned = True
+                continue
+        if writer.literal_bytes + position - literal_start > max_literal:
+            return None
+        if position + block_size < size:
+            out_byte = data[position]
+            a = (a - out_byte + data[position + block_size]) % ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+        aligned = False
+        position += 1
+    if size - literal_start + writer.literal_bytes > max_literal:
+        return None
+    writer.literal(data[literal_start:size])
+    writer.close()
+    return writer.literal_bytes
@@ -2,3 +2,15 @@ class ProbeManagerError(Exception):
     def __init__(self, message):
         super().__init__(message)
         self.message = message
+
+
+class ServerBusyError(ProbeManagerError):
+    pass
+
+
+class CircuitOpenError(ProbeManagerError):
+    pass
+
+
+class ProbeBusyError(ProbeManagerError):
+    pass
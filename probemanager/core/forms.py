@@ -8,7 +8,11 @@ class ServerForm(ModelForm):
         model = Server
         fields = (
                   'name', 'host', 'os', 'remote_user', 'remote_port', 'become', 'become_method', 'become_user',
-                  'become_pass', 'ssh_private_key_file')
+                  'become_pass', 'ssh_private_key_file', 'compression', 'ciphers')
         widgets = {
             'become_pass': PasswordInput(),
         }
+
+    def clean_ciphers(self):
+        # Validated by the model field (validate_ciphers).
+        return ','.join(cipher.strip() for cipher in self.cleaned_data['ciphers'].split(',') if cipher.strip())
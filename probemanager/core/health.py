@@ -0,0 +1,110 @@
+"""
+Health of the service of a probe : active state, uptime, PID, memory and number of rules,
+read in one remote call with 'systemctl show'.
+"""
+import shlex
+from datetime import timedelta
+
+PROPERTIES = ('LoadState', 'ActiveState', 'SubState', 'MainPID', 'MemoryCurrent', 'ActiveEnterTimestampMonotonic')
+
+
+def health_command(service, rules_count_command=None):
+    """
+    Returns the shell command printing the lines 'Uptime=...', 'RulesCount=...' and the properties of the service.
+    systemctl show is the last command, the exit code does not depend on the command counting the rules,
+    the echo ends the line even if this command prints nothing.
+    """
+    script = "printf 'Uptime='; cat /proc/uptime; "
+    if rules_count_command:
+        script += "printf 'RulesCount='; " + rules_count_command + "; echo; "
+    script += "systemctl show " + shlex.quote(service) + " --property=" + ','.join(PROPERTIES)
+    return "sh -c " + shlex.quote(script)
+
+
+def parse_int(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    # systemd prints 2^64 - 1 when the value is not available.
+    if value < 0 or value == 2 ** 64 - 1:
+        return None
+    return value
+
+
+class ProbeHealth:
+    """
+    State of the service of a probe. uptime is in seconds, memory in bytes, latency of the remote call
+    in milliseconds, each value is None when it is not known. transient is True when the error may not
+    happen again later (timeout, connection lost).
+    """
+    def __init__(self, state='unknown', sub_state='', uptime=None, pid=None, memory=None, rules_count=None,
+                 error=None, latency=None, transient=False):
+        self.state = state
+        self.sub_state = sub_state
+        self.uptime = uptime
+        self.pid = pid
+        self.memory = memory
+        self.rules_count = rules_count
+        self.error = error
+        self.latency = latency
+        self.transient = transient
+
+    def __str__(self):
+        if self.error:
+            return 'Failed to get the health : ' + self.error
+        if self.sub_state:
+            return self.state + ' (' + self.sub_state + ')'
+        return self.state
+
+    @property
+    def running(self):
+        return self.state == 'active' and self.sub_state == 'running'
+
+    @property
+    def uptime_display(self):
+        if self.uptime is None:
+            return 'Unknown'
+        return str(timedelta(seconds=int(self.uptime)))
+
+    def to_dict(self):
+        return {'state': self.state,
+                'sub_state': self.sub_state,
+                'uptime': self.uptime,
+                'pid': self.pid,
+                'memory': self.memory,
+                'rules_count': self.rules_count,
+                'error': self.error,
+                'latency': self.latency,
+                'transient': self.transient,
+                }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    @classmethod
+    def parse(cls, output):
+        values = dict()
+        for line in output.splitlines():
+            key, sep, value = line.partition('=')
+            if sep:
+                values[key.strip()] = value.strip()
+        if values.get('LoadState') == 'not-found':
+            return cls(state='not found')
+        health = cls(state=values.get('ActiveState', 'unknown'),
+                     sub_state=values.get('SubState', ''),
+                     memory=parse_int(values.get('MemoryCurrent')),
+                     rules_count=parse_int(values.get('RulesCount')),
+                     )
+        if health.state == 'active':
+            health.pid = parse_int(values.get('MainPID')) or None
+            started = parse_int(values.get('ActiveEnterTimestampMonotonic'))
+            try:
+                # /proc/uptime and ActiveEnterTimestampMonotonic (microseconds) are both since the boot.
+                system_uptime = float(values.get('Uptime', '').split()[0])
+            except (IndexError, ValueError):
+                system_uptime = None
+            if started and system_uptime is not None:
+                health.uptime = max(0, int(system_uptime - started / 1000000))
+        return health
@@ -1,15 +1,23 @@
+import json
 import logging
 import os
+import time
+from datetime import timedelta
 
+from django.apps import apps
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django_celery_beat.models import CrontabSchedule
 from paramiko.rsakey import RSAKey
 
+from .exceptions import ProbeBusyError
+from .health import ProbeHealth, health_command
 from .modelsmixins import CommonMixin
-from .ssh import execute
-from .utils import encrypt
+from .ssh import copy_done, execute, execute_stream, format_output, is_transient, pool, private_keys
+from .utils import encrypt, hash_rules, validate_ciphers
 
 logger = logging.getLogger(__name__)
 
@@ -27,24 +35,153 @@ class Job(CommonMixin, models.Model):
     result = models.TextField(null=True, default=None, editable=False)
     created = models.DateTimeField(default=timezone.now)
     completed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=1, editable=False)
 
     class Meta:
         ordering = ('-created',)
+        # Filters of the admin page and of the API, sorted by creation date.
+        indexes = [
+            models.Index(fields=['created']),
+            models.Index(fields=['status', 'created']),
+            models.Index(fields=['probe', 'created']),
+            models.Index(fields=['completed']),
+        ]
 
     def __str__(self):
         return str(self.name)
 
     @classmethod
-    def create_job(cls, name, probe_name):
+    def create_job(cls, name, probe_name, job_id=None):
+        """
+        job_id is the job of the previous attempt of a retried task, continued instead of created.
+        """
+        if job_id is not None:
+            job = cls.objects.filter(pk=job_id).first()
+            if job is not None:
+                job.attempts += 1
+                job.save(update_fields=['attempts'])
+                return job
         job = Job(name=name, probe=probe_name, status='In progress', created=timezone.now())
         job.save()
         return job
 
+    @classmethod
+    def create_fleet_job(cls, name, selection, probe_names):
+        """
+        Job of a task on several probes, the result is the JSON of the response of each probe.
+        """
+        job = cls.create_job(name, selection)
+        job.result = json.dumps({'total': len(probe_names), 'failed': 0, 'probes': dict()})
+        if not probe_names:
+            job.status = 'Completed'
+            job.completed = timezone.now()
+        job.save()
+        return job
+
+    @classmethod
+    def record_fleet_result(cls, pk, probe_name, response, failed):
+        """
+        Adds the response of a probe in a fleet job, the job is finished with the last probe.
+        """
+        with transaction.atomic():
+            job = cls.objects.select_for_update().get(pk=pk)
+            results = json.loads(job.result)
+            results['probes'][probe_name] = response
+            if failed:
+                results['failed'] += 1
+            if len(results['probes']) >= results['total']:
+                job.status = 'Error' if results['failed'] else 'Completed'
+                job.completed = timezone.now()
+            job.result = json.dumps(results, indent=1, sort_keys=True)
+            job.save()
+        return job
+
+    @classmethod
+    def stop_fleet_job(cls, pk, reason, skipped):
+        """
+        Ends a fleet job before all the probes are done, skipped are the names of the probes not done.
+        """
+        with transaction.atomic():
+            job = cls.objects.select_for_update().get(pk=pk)
+            results = json.loads(job.result)
+            results['stopped'] = reason
+            results['skipped'] = skipped
+            job.update_job(json.dumps(results, indent=1, sort_keys=True), 'Error')
+        return job
+
     def update_job(self, result, status):
         self.result = result
         self.status = status
         self.completed = timezone.now()
-        self.save()
+        self.save(update_fields=['result', 'status', 'completed'])
+
+    def append_result(self, text, force=False):
+        """
+        Appends output to the result of the running job. Keeps only the last JOB_RESULT_MAX_SIZE characters,
+        and saves at most every JOB_RESULT_SAVE_INTERVAL seconds, unless force is True.
+        """
+        self.result = ((self.result or '') + text)[-settings.JOB_RESULT_MAX_SIZE:]
+        now = time.monotonic()
+        if force or now - getattr(self, '_result_saved', 0) >= settings.JOB_RESULT_SAVE_INTERVAL:
+            self.save(update_fields=['result'])
+            self._result_saved = now
+
+    def execute(self, server, commands, become=False):
+        """
+        Executes the commands like ssh.execute(), but streams their output in the result of the job.
+        """
+        result = dict()
+        try:
+            for command_name, command in commands.items():
+                self.append_result("$ " + command_name + "\n")
+                output = ''
+                for source, text in execute_stream(server, command_name, command, become=become):
+                    self.append_result(text)
+                    if source == 'stdout':
+                        output = (output + text)[-settings.SSH_STREAM_TAIL_SIZE:]
+                result[command_name] = format_output(output)
+        finally:
+            self.append_result('', force=True)
+        return result
+
+
+class ProbeLock(models.Model):
+    """
+    Task in progress on a probe, at most one at the same time for all the workers.
+    """
+    probe = models.CharField(max_length=400, unique=True)
+    task = models.CharField(max_length=255)
+    created = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.probe) + ' - ' + str(self.task)
+
+    @classmethod
+    def acquire(cls, task, probe_name):
+        """
+        Returns (lock, None) when the lock is taken, or (None, job in progress) if the same task is already
+        running on the probe. Waits PROBE_LOCK_WAIT seconds if another task is running on the probe,
+        the locks older than PROBE_LOCK_TIMEOUT are considered abandoned.
+        """
+        deadline = time.monotonic() + settings.PROBE_LOCK_WAIT
+        while True:
+            cls.objects.filter(probe=probe_name,
+                               created__lt=timezone.now() - timedelta(seconds=settings.PROBE_LOCK_TIMEOUT)).delete()
+            try:
+                with transaction.atomic():
+                    return cls.objects.create(probe=probe_name, task=task), None
+            except IntegrityError:
+                pass
+            lock = cls.objects.filter(probe=probe_name).first()
+            if lock is not None:
+                if lock.task == task:
+                    return None, Job.objects.filter(name=task, probe=probe_name, status='In progress').first()
+                if time.monotonic() >= deadline:
+                    raise ProbeBusyError('Probe ' + str(probe_name) + ' busy with the task ' + str(lock.task))
+                time.sleep(1)
+
+    def release(self):
+        self.delete()
 
 
 class OsSupported(CommonMixin, models.Model):
@@ -69,9 +206,15 @@ class SshKey(models.Model):
 
     def save(self, **kwargs):
         super().save(**kwargs)
+        private_keys.invalidate(self)
         rsakey = RSAKey.from_private_key_file(settings.MEDIA_ROOT + "/" + self.file.name)
         rsakey.write_private_key_file(settings.MEDIA_ROOT + "/" + self.file.name, settings.SECRET_KEY)
         os.chmod(settings.MEDIA_ROOT + "/" + self.file.name, 0o640)
+        private_keys.set(self, rsakey)
+
+    def delete(self, **kwargs):
+        private_keys.invalidate(self)
+        return super().delete(**kwargs)
 
 
 class Server(CommonMixin, models.Model):
@@ -88,6 +231,9 @@ class Server(CommonMixin, models.Model):
     become_method = models.CharField(max_length=400, blank=True, default='sudo')
     become_user = models.CharField(max_length=400, blank=True, default='root')
     become_pass = models.CharField(max_length=400, blank=True, null=True)
+    compression = models.BooleanField(default=False, blank=True)
+    ciphers = models.CharField(max_length=400, blank=True, default='', validators=[validate_ciphers],
+                               help_text='Allowed ciphers, separated by commas. Empty for all.')
 
     def __str__(self):
         return str(self.name) + ' - ' + str(self.host) + ', Os : ' + str(self.os)
@@ -96,6 +242,11 @@ class Server(CommonMixin, models.Model):
         if self.become_pass:
             self.become_pass = encrypt(self.become_pass)
         super().save(**kwargs)
+        pool.discard(self)
+
+    def delete(self, **kwargs):
+        pool.discard(self)
+        return super().delete(**kwargs)
 
     def test(self):
         command = "cat /etc/hostname"
@@ -122,6 +273,73 @@ class Server(CommonMixin, models.Model):
             return {'status': True}
 
 
+class SshSession(models.Model):
+    """
+    SSH connection open on a server, to limit the concurrent connections across all the processes.
+    The slot expires SSH_SESSION_LEASE seconds after its last renewal.
+    """
+    server = models.ForeignKey(Server, on_delete=models.CASCADE)
+    owner = models.CharField(max_length=400)
+    created = models.DateTimeField(default=timezone.now)
+    renewed = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.server_id) + ' - ' + str(self.owner)
+
+
+class SshCircuit(models.Model):
+    """
+    Connection failures on a server, the SSH operations fail fast until opened_until.
+    """
+    server = models.OneToOneField(Server, on_delete=models.CASCADE)
+    failures = models.IntegerField(default=0)
+    opened_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return str(self.server_id)
+
+
+class TransferStatistic(CommonMixin, models.Model):
+    """
+    Statistics of a file uploaded on a server.
+    """
+    METHOD_CHOICES = (
+        ('Full', 'Full'),
+        ('Delta', 'Delta'),
+        ('Unchanged', 'Unchanged'),
+    )
+    server = models.ForeignKey(Server, on_delete=models.CASCADE)
+    created = models.DateTimeField(default=timezone.now)
+    dest = models.CharField(max_length=1000)
+    method = models.CharField(max_length=100, choices=METHOD_CHOICES)
+    size = models.BigIntegerField(default=0)
+    sent = models.BigIntegerField(default=0)
+    duration = models.FloatField(default=0)
+    compression = models.BooleanField(default=False)
+    cipher = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta:
+        ordering = ('-created',)
+
+    def __str__(self):
+        return str(self.server.name) + ' - ' + str(self.dest)
+
+    @property
+    def throughput(self):
+        if self.duration:
+            return int(self.size / self.duration)
+        return None
+
+
+@receiver(copy_done)
+def record_transfer(sender, server, dest, size, sent, duration, method, cipher, **kwargs):
+    try:
+        TransferStatistic.objects.create(server=server, dest=dest, method=method, size=size, sent=sent,
+                                         duration=duration, compression=server.compression, cipher=cipher or '')
+    except Exception:
+        logger.exception('Error during the record of the transfer statistic')
+
+
 class Probe(CommonMixin, models.Model):
     """
     A probe is an IDS.
@@ -142,6 +360,11 @@ class Probe(CommonMixin, models.Model):
                                                 null=True, on_delete=models.CASCADE)
     server = models.ForeignKey(Server, on_delete=models.CASCADE)
     installed = models.BooleanField('Probe Already installed', default=False)
+    tags = models.CharField(max_length=400, blank=True, default='',
+                            help_text='Tags to select the probe in the fleet tasks, separated by commas.')
+    rules_hash = models.CharField(max_length=64, blank=True, default='', editable=False)
+    # Job of the task in progress on the probe, see run_commands().
+    job = None
 
     def __str__(self):
         return str(self.name)
@@ -164,17 +387,116 @@ class Probe(CommonMixin, models.Model):
         else:
             return 'Not installed'
 
+    def run_commands(self, commands):
+        """
+        Executes the commands on the server of the probe, like execute(). During a task with a job
+        (self.job, set by install_probe and update_probe), their output is streamed in its result while they run.
+        """
+        if self.job is not None:
+            return self.job.execute(self.server, commands, become=True)
+        return execute(self.server, commands, become=True)
+
+    # The probes implement install(), update(), deploy_conf() and deploy_rules(), which return
+    # {'status': bool, 'errors': ..., 'transient': bool}. deploy_rules() adds 'unchanged': True when the files
+    # of the rules on the probe were already the same, for example when execute_copy(..., skip_identical=True)
+    # returns {'copy': 'Unchanged'} for all of them : the task deploy_rules then does not reload the probe.
+
+    def get_rules(self):
+        """
+        Querysets of the rules (rules.Rule) deployed on the probe : the rules of its rulesets, found from the
+        many-to-many fields of the probe to a rules.RuleSet and of the ruleset to a rules.Rule
+        (example: Suricata.rulesets, RuleSetSuricata.signatures and RuleSetSuricata.scripts).
+        The probes with other rules override it. None without rulesets, the rules are then always deployed.
+        """
+        rule_model = apps.get_model('rules', 'Rule')
+        ruleset_model = apps.get_model('rules', 'RuleSet')
+        querysets = list()
+        for field in self._meta.many_to_many:
+            if not issubclass(field.related_model, ruleset_model):
+                continue
+            rulesets = getattr(self, field.name).all()
+            for rules_field in field.related_model._meta.many_to_many:
+                if issubclass(rules_field.related_model, rule_model):
+                    querysets.append(rules_field.related_model.objects.filter(
+                        **{rules_field.related_query_name() + '__in': rulesets}))
+        return querysets or None
+
+    def get_rules_hash(self):
+        querysets = self.get_rules()
+        if querysets is None:
+            return None
+        return hash_rules(querysets)
+
+    def set_rules_hash(self, value):
+        self.rules_hash = value or ''
+        Probe.objects.filter(pk=self.pk).update(rules_hash=self.rules_hash)
+
+    def rules_count_command(self):
+        """
+        Shell command printing the number of rules deployed on the probe, None if unknown.
+        """
+        return None
+
+    def health(self):
+        """
+        Active state, uptime, PID, memory and number of rules of the probe, in one remote call.
+        """
+        if not self.installed:
+            return ProbeHealth(state='not installed')
+        if self.server.os.name == 'debian' or self.server.os.name == 'ubuntu':
+            command = health_command(self.__class__.__name__.lower(), self.rules_count_command())
+        else:  # pragma: no cover
+            raise NotImplementedError
+        start = time.monotonic()
+        try:
+            output = ''.join(text for source, text in execute_stream(self.server, 'health', command, become=True)
+                             if source == 'stdout')
+        except Exception as e:
+            logger.exception('Failed to get the health')
+            return ProbeHealth(error=str(e), transient=is_transient(e))
+        logger.debug("output : " + str(output))
+        health = ProbeHealth.parse(output)
+        health.latency = round((time.monotonic() - start) * 1000, 1)
+        return health
+
+    def last_status(self):
+        """
+        Last health of the probe in the cache (ProbeStatus), without remote call. None if never checked.
+        """
+        try:
+            return self.cached_status
+        except ProbeStatus.DoesNotExist:
+            return None
+
+    def refresh_health(self, samples=None):
+        """
+        Gets the health of the probe and stores it in the cache. The sample of the health is added to the list
+        samples if given, to be saved with the samples of the other probes (bulk_create), else it is saved.
+        """
+        health = self.health()
+        self.cached_status = ProbeStatus.store(self, health)
+        sample = ProbeHealthSample.from_health(self, health)
+        if samples is None:
+            sample.save()
+        else:
+            samples.append(sample)
+        return health
+
+    def invalidate_status(self):
+        ProbeStatus.objects.filter(probe_id=self.pk).delete()
+
     def restart(self):
         if self.server.os.name == 'debian' or self.server.os.name == 'ubuntu':
             command = "service " + self.__class__.__name__.lower() + " restart"
         else:  # pragma: no cover
             raise NotImplementedError
         tasks = {"restart": command}
+        self.invalidate_status()
         try:
             response = execute(self.server, tasks, become=True)
-        except Exception:
+        except Exception as e:
             logger.exception("Error during restart")
-            return {'status': False, 'errors': "Error during restart"}
+            return {'status': False, 'errors': "Error during restart", 'transient': is_transient(e)}
         else:
             logger.debug("output : " + str(response))
             return {'status': True}
@@ -185,11 +507,12 @@ class Probe(CommonMixin, models.Model):
         else:  # pragma: no cover
             raise NotImplementedError
         tasks = {"start": command}
+        self.invalidate_status()
         try:
             response = execute(self.server, tasks, become=True)
-        except Exception:
+        except Exception as e:
             logger.exception("Error during start")
-            return {'status': False, 'errors': "Error during start"}
+            return {'status': False, 'errors': "Error during start", 'transient': is_transient(e)}
         else:
             logger.debug("output : " + str(response))
             return {'status': True}
@@ -200,11 +523,12 @@ class Probe(CommonMixin, models.Model):
         else:  # pragma: no cover
             raise NotImplementedError
         tasks = {"stop": command}
+        self.invalidate_status()
         try:
             response = execute(self.server, tasks, become=True)
-        except Exception:
+        except Exception as e:
             logger.exception("Error during stop")
-            return {'status': False, 'errors': "Error during stop"}
+            return {'status': False, 'errors': "Error during stop", 'transient': is_transient(e)}
         else:
             logger.debug("output : " + str(response))
             return {'status': True}
@@ -233,11 +557,12 @@ class Probe(CommonMixin, models.Model):
         else:  # pragma: no cover
             raise NotImplementedError
         tasks = {"reload": command}
+        self.invalidate_status()
         try:
             response = execute(self.server, tasks, become=True)
-        except Exception:
+        except Exception as e:
             logger.exception("Error during reload")
-            return {'status': False, 'errors': "Error during reload"}
+            return {'status': False, 'errors': "Error during reload", 'transient': is_transient(e)}
         else:
             logger.debug("output : " + str(response))
             return {'status': True}
@@ -252,6 +577,109 @@ class Probe(CommonMixin, models.Model):
         return probe
 
 
+class ProbeStatus(models.Model):
+    """
+    Cache of the last health of a probe, filled by the checks. The pages read it instead of a remote call.
+    """
+    probe = models.OneToOneField(Probe, on_delete=models.CASCADE, primary_key=True, related_name='cached_status')
+    health_values = models.TextField(default='{}')
+    updated = models.DateTimeField(default=timezone.now)
+    # Written only by the task check_probe, the other refreshes of the cache do not hide a transition from it.
+    last_check_running = models.NullBooleanField(editable=False)
+
+    def __str__(self):
+        return str(self.probe_id) + ' - ' + str(self.updated)
+
+    @classmethod
+    def store(cls, probe, health):
+        values = {'health_values': json.dumps(health.to_dict()), 'updated': timezone.now()}
+        # One UPDATE of the row of the probe, the INSERT only for the first check.
+        if cls.objects.filter(probe_id=probe.pk).update(**values):
+            return cls(probe_id=probe.pk, **values)
+        try:
+            with transaction.atomic():
+                return cls.objects.create(probe_id=probe.pk, **values)
+        except IntegrityError:
+            # Created at the same time by another check.
+            cls.objects.filter(probe_id=probe.pk).update(**values)
+            return cls(probe_id=probe.pk, **values)
+
+    @classmethod
+    def store_check(cls, probe, running):
+        """
+        Stores the state seen by check_probe : True, False, or None after an error.
+        """
+        cls.objects.filter(probe_id=probe.pk).update(last_check_running=running)
+
+    @property
+    def age(self):
+        return timezone.now() - self.updated
+
+    @property
+    def stale(self):
+        return self.age > timedelta(seconds=settings.PROBE_STATUS_TTL)
+
+    @property
+    def health(self):
+        """
+        The health when it was checked, with the uptime until now.
+        """
+        health = ProbeHealth.from_dict(json.loads(self.health_values))
+        if health.running and health.uptime is not None:
+            health.uptime += int(self.age.total_seconds())
+        return health
+
+
+class ProbeHealthSample(models.Model):
+    """
+    Health of a probe at each check, for the availability and the SSH latency over time.
+    """
+    STATE_CHOICES = (
+        ('running', 'Running'),
+        ('stopped', 'Stopped'),
+        ('failed', 'Failed'),
+        ('unreachable', 'Unreachable'),
+    )
+    probe = models.ForeignKey(Probe, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(default=timezone.now)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES)
+    uptime = models.IntegerField(null=True, blank=True)
+    latency = models.FloatField(null=True, blank=True, verbose_name='Latency (ms)')
+
+    class Meta:
+        ordering = ('-timestamp',)
+        indexes = [
+            models.Index(fields=['probe', 'timestamp']),
+        ]
+
+    def __str__(self):
+        return str(self.probe_id) + ' - ' + str(self.timestamp) + ' - ' + str(self.state)
+
+    @classmethod
+    def from_health(cls, probe, health):
+        """
+        Returns the sample (not saved) of a ProbeHealth, to save them with bulk_create.
+        """
+        if health.error:
+            state = 'unreachable'
+        elif health.running:
+            state = 'running'
+        elif health.state == 'failed':
+            state = 'failed'
+        else:
+            state = 'stopped'
+        return cls(probe_id=probe.pk, state=state, uptime=health.uptime, latency=health.latency)
+
+    @classmethod
+    def purge(cls):
+        """
+        Deletes the samples older than PROBE_HEALTH_RETENTION_DAYS.
+        """
+        limit = timezone.now() - timedelta(days=settings.PROBE_HEALTH_RETENTION_DAYS)
+        deleted, rows = cls.objects.filter(timestamp__lt=limit).delete()
+        return deleted
+
+
 class ProbeConfiguration(CommonMixin, models.Model):
     """
     Configuration for a probe, Allows you to reuse the configuration.
@@ -270,15 +698,41 @@ class Configuration(models.Model):
     key = models.CharField(max_length=100, unique=True, blank=False, null=False)
     value = models.CharField(max_length=300, blank=True, null=False)
 
+    # Per-process snapshot of all the configuration : {key: value}, the time it was read, and the number of
+    # invalidations, a snapshot read during an invalidation is not kept.
+    _values = None
+    _loaded = 0
+    _generation = 0
+
     def __str__(self):
         return str(self.key)
 
+    @classmethod
+    def get_values(cls, *keys):
+        """
+        Returns {key: value} for the keys, all the keys by default, the value is None if empty or unknown.
+        All the configuration is read in one query and kept CONFIGURATION_CACHE_TTL seconds, or until a configuration
+        is saved or deleted in this process. Not kept if read in a transaction, it may not be committed.
+        """
+        values = cls._values
+        if values is None or time.monotonic() - cls._loaded > settings.CONFIGURATION_CACHE_TTL:
+            generation = cls._generation
+            values = dict(cls.objects.values_list('key', 'value'))
+            if generation == cls._generation and not connection.in_atomic_block:
+                cls._values = values
+                cls._loaded = time.monotonic()
+        return {key: values.get(key) or None for key in keys or values}
+
     @classmethod
     def get_value(cls, key):
-        try:
-            if cls.objects.get(key=key).value != "":
-                return cls.objects.get(key=key).value
-            else:
-                return None
-        except cls.DoesNotExist:
-            return None
+        return cls.get_values(key)[key]
+
+    @classmethod
+    def invalidate(cls):
+        cls._generation += 1
+        cls._values = None
+
+
+@receiver([post_save, post_delete], sender=Configuration)
+def invalidate_configuration(sender, **kwargs):
+    Configuration.invalidate()
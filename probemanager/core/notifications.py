@@ -16,9 +16,10 @@ logger = logging.getLogger('core.notifications')
 
 
 def pushbullet(title, plain_body):  # pragma: no cover
-    if Configuration.get_value("PUSHBULLET_API_KEY"):
+    api_key = Configuration.get_value("PUSHBULLET_API_KEY")
+    if api_key:
         try:
-            pb = Pushbullet(Configuration.get_value("PUSHBULLET_API_KEY"))
+            pb = Pushbullet(api_key)
             push = pb.push_note(title, plain_body)
             logger.debug(push)
         except InvalidKeyError:
@@ -28,15 +29,13 @@ def pushbullet(title, plain_body):  # pragma: no cover
 
 
 def splunk(html_body):  # pragma: no cover
-    if Configuration.get_value("SPLUNK_HOST"):
-        if Configuration.get_value("SPLUNK_USER") and Configuration.get_value("SPLUNK_PASSWORD"):
-            url = "https://" + Configuration.get_value(
-                "SPLUNK_HOST") + ":8089/services/receivers/simple?source=ProbeManager&sourcetype=notification"
-            r = requests.post(url, verify=False, data=html_body,
-                              auth=(Configuration.get_value("SPLUNK_USER"), Configuration.get_value("SPLUNK_PASSWORD")))
+    conf = Configuration.get_values("SPLUNK_HOST", "SPLUNK_USER", "SPLUNK_PASSWORD")
+    if conf["SPLUNK_HOST"]:
+        url = "https://" + conf["SPLUNK_HOST"] + \
+              ":8089/services/receivers/simple?source=ProbeManager&sourcetype=notification"
+        if conf["SPLUNK_USER"] and conf["SPLUNK_PASSWORD"]:
+            r = requests.post(url, verify=False, data=html_body, auth=(conf["SPLUNK_USER"], conf["SPLUNK_PASSWORD"]))
         else:
-            url = "https://" + Configuration.get_value(
-                "SPLUNK_HOST") + ":8089/services/receivers/simple?source=ProbeManager&sourcetype=notification"
             r = requests.post(url, verify=False, data=html_body)
         logger.debug("Splunk " + str(r.text))
 
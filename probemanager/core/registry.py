@@ -0,0 +1,90 @@
+"""
+Concrete model class of each type of probe, built once when the apps are ready.
+"""
+import logging
+
+from django.apps import apps
+from django.core.exceptions import ObjectDoesNotExist
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeRegistry:
+    """
+    Maps (app label, class name) to the model class of the probes, like
+    getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype or probe.type).
+    """
+    def __init__(self):
+        self.classes = dict()
+        # Path from Probe to each model for select_related, example: 'suricata'
+        self.paths = dict()
+
+    def build(self):
+        probe_class = apps.get_model('core', 'Probe')
+        self.classes.clear()
+        self.paths.clear()
+        for model in apps.get_models():
+            if issubclass(model, probe_class) and model is not probe_class and not model._meta.proxy:
+                self.classes[(model._meta.app_label, model.__name__)] = model
+                parents = [parent for parent in reversed(model._meta.get_parent_list())
+                           if issubclass(parent, probe_class) and parent is not probe_class]
+                self.paths[model] = '__'.join(parent._meta.model_name for parent in parents + [model])
+
+    def get_class(self, probe_type, subtype=None):
+        if not probe_type:
+            return apps.get_model('core', 'Probe')
+        return self.classes.get((probe_type.lower(), subtype or probe_type))
+
+    def queryset(self):
+        probe_class = apps.get_model('core', 'Probe')
+        return probe_class.objects.select_related('server__os', 'server__ssh_private_key_file', *self.paths.values())
+
+    def concrete(self, probe):
+        """
+        Returns the concrete probe of a probe loaded with queryset(), without query. None if it has no model.
+        """
+        model = self.get_class(probe.type, probe.subtype)
+        if model is None:
+            logger.error('No model for the probe ' + str(probe.name) + ', type : ' + str(probe.type) +
+                         ', subtype : ' + str(probe.subtype))
+            return None
+        if model not in self.paths:
+            return probe
+        instance = probe
+        try:
+            for name in self.paths[model].split('__'):
+                instance = getattr(instance, name)
+        except ObjectDoesNotExist as e:
+            logger.debug('Tries to access an object that does not exist : ' + str(e))
+            return None
+        # Already loaded with the base probe.
+        instance.server = probe.server
+        return instance
+
+    def get_probe(self, **kwargs):
+        """
+        Returns the concrete probe with its server, in one query. None if it does not exist.
+        """
+        queryset = self.queryset()
+        try:
+            probe = queryset.get(**kwargs)
+        except queryset.model.DoesNotExist as e:
+            logger.debug('Tries to access an object that does not exist : ' + str(e))
+            return None
+        return self.concrete(probe)
+
+    def filter(self, *args, **kwargs):
+        """
+        Returns the list of the concrete probes matching the filters, in one query.
+        """
+        probes = [self.concrete(probe) for probe in self.queryset().filter(*args, **kwargs)]
+        return [probe for probe in probes if probe is not None]
+
+    def get_by_id(self, pk):
+        return self.get_probe(pk=pk)
+
+    def get_by_name(self, name):
+        return self.get_probe(name=name)
+
+
+registry = ProbeRegistry()
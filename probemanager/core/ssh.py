@@ -1,81 +1,867 @@
+import asyncio
+import atexit
+import codecs
+import errno
+import hashlib
 import logging
 import os
+import random
+import re
+import select
+import shlex
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
 
 import paramiko
+from django.apps import apps
 from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+from django.dispatch import Signal
+from django.utils import timezone
 
-from .utils import decrypt
+from . import delta as delta_transfer
+from .exceptions import CircuitOpenError, ServerBusyError
+from .utils import decrypt, get_tmp_dir, sha256_file
 
 logger = logging.getLogger(__name__)
 
+TRANSPORT_ERRORS = (paramiko.SSHException, EOFError, socket.error)
+# Connection reset or refused, timeout, host or network temporarily unreachable.
+TRANSIENT_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.ETIMEDOUT, errno.EHOSTUNREACH,
+                    errno.ENETUNREACH, errno.EHOSTDOWN, errno.ENETDOWN, errno.EPIPE)
 
-def connection(server):
+copy_done = Signal(providing_args=['server', 'dest', 'size', 'sent', 'duration', 'method', 'cipher'])
+
+
+# The key types of the private keys, key_filename of SSHClient.connect() accepted them all.
+KEY_CLASSES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+
+class PrivateKeyCache:
+    """
+    Per-process cache of the decrypted private keys, keyed by SshKey id and file modification time.
+    """
+    def __init__(self):
+        self._keys = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_path(ssh_key):
+        return settings.MEDIA_ROOT + "/" + ssh_key.file.name
+
+    def get(self, ssh_key):
+        path = self.get_path(ssh_key)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._keys.get(ssh_key.pk)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        pkey = self.load(path)
+        self.set(ssh_key, pkey, mtime)
+        return pkey
+
+    @staticmethod
+    def load(path):
+        """
+        Loads the private key with the first key type which can read it.
+        """
+        error = None
+        for key_class in KEY_CLASSES:
+            try:
+                return key_class.from_private_key_file(path, password=settings.SECRET_KEY)
+            except (paramiko.SSHException, ValueError) as e:
+                error = e
+        raise error
+
+    def set(self, ssh_key, pkey, mtime=None):
+        if mtime is None:
+            mtime = os.path.getmtime(self.get_path(ssh_key))
+        with self._lock:
+            self._keys[ssh_key.pk] = (mtime, pkey)
+
+    def invalidate(self, ssh_key):
+        with self._lock:
+            self._keys.pop(ssh_key.pk, None)
+
+
+private_keys = PrivateKeyCache()
+
+
+def is_transient(exception):
+    """
+    True if the error may not happen again later : timeout, connection lost or refused, host unreachable,
+    server busy. False for the permanent errors, like a failed command or a refused authentication.
+    """
+    if isinstance(exception, (socket.timeout, EOFError, ServerBusyError)):
+        return True
+    if isinstance(exception, paramiko.ssh_exception.NoValidConnectionsError):
+        return all(is_transient(error) for error in exception.errors.values())
+    if isinstance(exception, (paramiko.AuthenticationException, paramiko.BadHostKeyException)):
+        return False
+    if isinstance(exception, paramiko.SSHException):
+        # Negotiation or session lost, not the answer of the server to a request.
+        return 'Error reading SSH protocol banner' in str(exception) or 'SSH session not active' in str(exception)
+    if isinstance(exception, socket.gaierror):
+        return exception.errno == socket.EAI_AGAIN
+    if isinstance(exception, OSError):
+        return exception.errno in TRANSIENT_ERRNOS
+    return False
+
+
+def get_disabled_algorithms(server):
+    """
+    Disables the ciphers which are not in the ciphers of the server. Empty means all the ciphers of paramiko.
+    """
+    ciphers = [cipher.strip() for cipher in server.ciphers.split(',') if cipher.strip()]
+    if not ciphers:
+        return None
+    return {'ciphers': [cipher for cipher in paramiko.Transport._preferred_ciphers if cipher not in ciphers]}
+
+
+def connection(server, pkey=None):
+    if pkey is None:
+        pkey = private_keys.get(server.ssh_private_key_file)
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     client.connect(hostname=server.host,
                    username=server.remote_user,
                    port=server.remote_port,
-                   key_filename=settings.MEDIA_ROOT + "/" + server.ssh_private_key_file.file.name,
-                   passphrase=settings.SECRET_KEY,
+                   pkey=pkey,
+                   compress=server.compression,
+                   disabled_algorithms=get_disabled_algorithms(server),
+                   timeout=settings.SSH_CONNECT_TIMEOUT,
+                   banner_timeout=settings.SSH_CONNECT_TIMEOUT,
+                   auth_timeout=settings.SSH_CONNECT_TIMEOUT,
                    )
+    set_nodelay(client)
     return client
 
 
-def execute(server, commands, become=False):
+def set_nodelay(client):
+    """
+    Like OpenSSH for the interactive sessions : the small messages of a command are sent without waiting
+    for the delayed ACK of the previous one, about 40 ms per command otherwise. Only for a TCP socket.
+    """
+    sock = client.get_transport().sock
+    if isinstance(sock, socket.socket) and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class PooledConnection:
+    """
+    A SSH client kept open in the pool, with the number of callers currently using it,
+    and its slot on the server (see ServerGuard).
+    """
+    def __init__(self, client, slot=None):
+        self.client = client
+        self.slot = slot
+        self.slot_renewed = time.monotonic()
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.retired = False
+
+    def is_alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:  # pragma: no cover
+            logger.debug('Error during the close of a pooled connection', exc_info=True)
+        if self.slot is not None:
+            try:
+                self.slot.delete()
+            except Exception:  # pragma: no cover
+                logger.debug('Error during the release of the slot of a pooled connection', exc_info=True)
+            self.slot = None
+
+
+class ServerGuard:
+    """
+    Limits the number of SSH connections open on the same server across all the processes, with a row
+    in the database (SshSession) for each pooled connection : the slot is taken when the connection is opened,
+    renewed at most every lease / 2 seconds while the connection is used, and freed when it is closed.
+    The slot of a crashed process expires after the lease. The commands on an open connection make no query.
+    After repeated connection failures on a server, the connections fail fast until the cooldown is over
+    (circuit breaker). The failures are recorded by the pool, only when the connection cannot be established
+    or is lost, not for the local errors of an operation.
+    """
+    def __init__(self, max_sessions, wait_timeout, lease, failures, cooldown):
+        self.max_sessions = max_sessions
+        self.wait_timeout = wait_timeout
+        self.lease = lease
+        self.failures = failures
+        self.cooldown = cooldown
+
+    def check_circuit(self, server):
+        circuit = apps.get_model('core', 'SshCircuit').objects.filter(server_id=server.pk).first()
+        if circuit is not None and circuit.opened_until is not None and circuit.opened_until > timezone.now():
+            raise CircuitOpenError("Server " + str(server.name) + " unreachable, " + str(circuit.failures) +
+                                   " failures, next try after " + str(circuit.opened_until))
+        return circuit
+
+    def record_failure(self, server):
+        circuit_model = apps.get_model('core', 'SshCircuit')
+        try:
+            with transaction.atomic():
+                circuit, created = circuit_model.objects.select_for_update().get_or_create(server_id=server.pk)
+                circuit.failures += 1
+                if circuit.failures >= self.failures:
+                    circuit.opened_until = timezone.now() + timedelta(seconds=self.cooldown)
+                    logger.warning("Circuit opened for server " + str(server.name) + " until " +
+                                   str(circuit.opened_until))
+                circuit.save()
+        except DatabaseError:
+            logger.exception("Error during the record of the failure")
+
+    def reset(self, server):
+        circuit_model = apps.get_model('core', 'SshCircuit')
+        circuit_model.objects.filter(server_id=server.pk).update(failures=0, opened_until=None)
+
+    def acquire_slot(self, server):
+        """
+        Queues the connection, it can be opened when there are less than max_sessions connections before it.
+        Returns the slot, None without limit.
+        """
+        if not self.max_sessions or server.pk is None:
+            return None
+        session_model = apps.get_model('core', 'SshSession')
+        owner = socket.gethostname() + ':' + str(os.getpid())
+        session = session_model.objects.create(server_id=server.pk, owner=owner)
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            session_model.objects.filter(server_id=server.pk,
+                                         renewed__lt=timezone.now() - timedelta(seconds=self.lease)).delete()
+            if session_model.objects.filter(server_id=server.pk, id__lt=session.id).count() < self.max_sessions:
+                return session
+            if time.monotonic() > deadline:
+                session.delete()
+                raise ServerBusyError("Server " + str(server.name) + " busy, " + str(self.max_sessions) +
+                                      " SSH connections already open")
+            time.sleep(random.uniform(0.1, 0.5))
+
+    def renew_slot(self, server, pooled):
+        """
+        Renews the lease of the slot of a pooled connection in use, takes a new slot if it expired meanwhile.
+        """
+        if pooled.slot is None or time.monotonic() - pooled.slot_renewed < self.lease / 2:
+            return
+        session_model = apps.get_model('core', 'SshSession')
+        if not session_model.objects.filter(pk=pooled.slot.pk).update(renewed=timezone.now()):
+            pooled.slot = self.acquire_slot(server)
+        pooled.slot_renewed = time.monotonic()
+
+    def connect(self, server):
+        """
+        Opens a connection to the server in a slot, returns (client, slot).
+        """
+        circuit = self.check_circuit(server)
+        slot = self.acquire_slot(server)
+        try:
+            # A missing or unreadable key is not a failure of the server.
+            pkey = private_keys.get(server.ssh_private_key_file)
+            try:
+                client = connection(server, pkey=pkey)
+            except TRANSPORT_ERRORS:
+                self.record_failure(server)
+                raise
+        except Exception:
+            if slot is not None:
+                slot.delete()
+            raise
+        if circuit is not None and circuit.failures:
+            self.reset(server)
+        return client, slot
+
+
+class SshConnectionPool:
+    """
+    Per-process pool of SSH connections, keyed by Server.
+    Reuses a live transport for every command sent to the same server.
+    """
+    def __init__(self, max_size, idle_timeout, keepalive, guard):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.guard = guard
+        self._connections = OrderedDict()
+        self._server_locks = dict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def get_key(server):
+        return (server.pk, server.host, server.remote_port, server.remote_user, server.ssh_private_key_file_id)
+
+    def _check_pid(self):
+        # After a fork (Celery prefork workers), the sockets belong to the parent process.
+        if self._pid != os.getpid():
+            self._connections = OrderedDict()
+            self._server_locks = dict()
+            self._pid = os.getpid()
+
+    def _evict(self):
+        now = time.monotonic()
+        for key, pooled in list(self._connections.items()):
+            if pooled.users == 0 and (now - pooled.last_used > self.idle_timeout or not pooled.is_alive()):
+                del self._connections[key]
+                pooled.close()
+        idle = [key for key, pooled in self._connections.items() if pooled.users == 0]
+        while len(self._connections) > self.max_size and idle:
+            self._connections.pop(idle.pop(0)).close()
+
+    def acquire(self, server):
+        """
+        Returns a live pooled connection for this server, reconnecting if the transport is dead.
+        """
+        key = self.get_key(server)
+        with self._lock:
+            self._check_pid()
+            self._evict()
+            server_lock = self._server_locks.setdefault(key, threading.Lock())
+        with server_lock:
+            with self._lock:
+                pooled = self._connections.get(key)
+                alive = pooled is not None and pooled.is_alive()
+                if alive:
+                    pooled.users += 1
+                    self._connections.move_to_end(key)
+                elif pooled is not None:
+                    logger.debug('Pooled connection to ' + str(server.host) + ' is dead, reconnecting')
+                    self._retire(key, pooled)
+            if alive:
+                try:
+                    self.guard.renew_slot(server, pooled)
+                except Exception:
+                    self.release(pooled)
+                    raise
+                return pooled
+            client, slot = self.guard.connect(server)
+            if self.keepalive:
+                client.get_transport().set_keepalive(self.keepalive)
+            pooled = PooledConnection(client, slot)
+            pooled.users += 1
+            with self._lock:
+                self._connections[key] = pooled
+                self._evict()
+            return pooled
+
+    def lost(self, server, pooled):
+        """
+        True if the transport of the pooled connection is lost, recorded as a failure of the server.
+        """
+        if pooled.is_alive():
+            return False
+        self.guard.record_failure(server)
+        return True
+
+    def release(self, pooled, broken=False):
+        with self._lock:
+            pooled.users -= 1
+            pooled.last_used = time.monotonic()
+            if broken and not pooled.retired:
+                for key, value in list(self._connections.items()):
+                    if value is pooled:
+                        self._retire(key, pooled)
+            if pooled.retired and pooled.users <= 0:
+                pooled.close()
+
+    def _retire(self, key, pooled):
+        if self._connections.get(key) is pooled:
+            del self._connections[key]
+        pooled.retired = True
+        if pooled.users <= 0:
+            pooled.close()
+
+    def discard(self, server):
+        """
+        Closes the connections of this server, for example when the server is modified or deleted.
+        """
+        with self._lock:
+            for key, pooled in list(self._connections.items()):
+                if key[0] == server.pk:
+                    self._retire(key, pooled)
+
+    def close_all(self):
+        with self._lock:
+            for key, pooled in list(self._connections.items()):
+                self._retire(key, pooled)
+
+    @contextmanager
+    def client(self, server):
+        pooled = self.acquire(server)
+        broken = False
+        try:
+            yield pooled.client
+        except TRANSPORT_ERRORS:
+            broken = self.lost(server, pooled)
+            raise
+        finally:
+            self.release(pooled, broken)
+
+    @contextmanager
+    def exec_command(self, server, command):
+        """
+        Opens a session on a pooled connection and executes the command.
+        If the channel cannot be opened, the connection is dropped and the pool reconnects once.
+        """
+        pooled = self.acquire(server)
+        try:
+            channels = pooled.client.exec_command(command, timeout=settings.SSH_COMMAND_TIMEOUT)
+        except TRANSPORT_ERRORS:
+            self.release(pooled, broken=True)
+            pooled = self.acquire(server)
+            try:
+                channels = pooled.client.exec_command(command, timeout=settings.SSH_COMMAND_TIMEOUT)
+            except TRANSPORT_ERRORS:
+                # No session on a new connection.
+                self.guard.record_failure(server)
+                self.release(pooled, broken=True)
+                raise
+        broken = False
+        try:
+            yield channels
+        except TRANSPORT_ERRORS:
+            broken = self.lost(server, pooled)
+            raise
+        finally:
+            self.release(pooled, broken)
+
+
+guard = ServerGuard(max_sessions=settings.SSH_MAX_SESSIONS_PER_SERVER,
+                    wait_timeout=settings.SSH_SESSION_WAIT_TIMEOUT,
+                    lease=settings.SSH_SESSION_LEASE,
+                    failures=settings.SSH_CIRCUIT_FAILURES,
+                    cooldown=settings.SSH_CIRCUIT_COOLDOWN)
+pool = SshConnectionPool(max_size=settings.SSH_POOL_MAX_SIZE,
+                         idle_timeout=settings.SSH_POOL_IDLE_TIMEOUT,
+                         keepalive=settings.SSH_KEEPALIVE_INTERVAL,
+                         guard=guard)
+atexit.register(pool.close_all)
+
+
+def become_command(server, command):
+    if server.become:
+        if server.become_pass is not None:
+            password = decrypt(server.become_pass)
+            return " echo '" + password + "' | " + server.become_method + " -S " + command
+        else:
+            return server.become_method + " " + command
+    else:
+        raise Exception("Server cannot become", server.name)
+
+
+def wait_exit_status(channel):
+    """
+    recv_exit_status() limited to SSH_COMMAND_TIMEOUT seconds, a hung command does not block the thread.
+    """
+    if not channel.status_event.wait(settings.SSH_COMMAND_TIMEOUT):
+        raise socket.timeout("No exit status after " + str(settings.SSH_COMMAND_TIMEOUT) + "s")
+    return channel.recv_exit_status()
+
+
+def open_sftp(client):
+    """
+    SFTP client whose operations fail after SSH_COMMAND_TIMEOUT seconds without answer.
+    """
+    ftp_client = client.open_sftp()
+    ftp_client.get_channel().settimeout(settings.SSH_COMMAND_TIMEOUT)
+    return ftp_client
+
+
+def format_output(output):
+    output = output.replace('\n', '')
+    if output == '':
+        return 'OK'
+    return output
+
+
+def execute(server, commands, become=False, batch=False):
+    if batch and len(commands) > 1:
+        return execute_batch(server, commands, become=become)
     result = dict()
     for command_name, command in commands.items():
         if become:
-            if server.become:
-                if server.become_pass is not None:
-                    password = decrypt(server.become_pass)
-                    command = " echo '" + password + \
-                              "' | " + server.become_method + " -S " + command
-                else:
-                    command = server.become_method + " " + command
+            command = become_command(server, command)
+        with pool.exec_command(server, command) as (stdin, stdout, stderr):
+            exit_status = wait_exit_status(stdout.channel)
+            if exit_status != 0:
+                raise Exception("Command Failed",
+                                "Command: " + command_name +
+                                " Exitcode: " + str(exit_status) +
+                                " Message: " + stdout.read().decode('utf-8') +
+                                " Error: " + str(stderr.readlines())
+                                )
             else:
-                raise Exception("Server cannot become", server.name)
-        client = connection(server)
-        stdin, stdout, stderr = client.exec_command(command)
-        if stdout.channel.recv_exit_status() != 0:
+                result[command_name] = format_output(stdout.read().decode('utf-8'))
+    return result
+
+
+def read_channel(channel):
+    """
+    Yields ('stdout' or 'stderr', data) as soon as the output arrives, from both streams together : a command
+    writing a lot on one of them does not block on the full window of the channel. Raises socket.timeout after
+    SSH_COMMAND_TIMEOUT seconds without output.
+    """
+    last_output = time.monotonic()
+    while True:
+        select.select([channel], [], [], settings.SSH_STREAM_POLL_INTERVAL)
+        chunks = list()
+        while channel.recv_ready():
+            chunks.append(('stdout', channel.recv(settings.SSH_STREAM_CHUNK_SIZE)))
+        while channel.recv_stderr_ready():
+            chunks.append(('stderr', channel.recv_stderr(settings.SSH_STREAM_CHUNK_SIZE)))
+        for chunk in chunks:
+            yield chunk
+        if not chunks and channel.exit_status_ready() and (channel.eof_received or channel.closed):
+            return
+        if chunks:
+            last_output = time.monotonic()
+        elif time.monotonic() - last_output > settings.SSH_COMMAND_TIMEOUT:
+            raise socket.timeout("No output after " + str(settings.SSH_COMMAND_TIMEOUT) + "s")
+
+
+def execute_stream(server, command_name, command, become=False):
+    """
+    Executes the command and yields ('stdout' or 'stderr', text) as soon as the output arrives.
+    Only the last SSH_STREAM_TAIL_SIZE characters of each stream are kept in memory,
+    for the exception raised like execute() if the exit code is not 0.
+    """
+    if become:
+        command = become_command(server, command)
+    tails = {'stdout': '', 'stderr': ''}
+    decoders = {'stdout': codecs.getincrementaldecoder('utf-8')('replace'),
+                'stderr': codecs.getincrementaldecoder('utf-8')('replace')}
+    with pool.exec_command(server, command) as (stdin, stdout, stderr):
+        channel = stdout.channel
+        try:
+            for source, data in read_channel(channel):
+                text = decoders[source].decode(data)
+                if text:
+                    tails[source] = (tails[source] + text)[-settings.SSH_STREAM_TAIL_SIZE:]
+                    yield source, text
+            exit_status = wait_exit_status(channel)
+        finally:
+            channel.close()
+    if exit_status != 0:
+        raise Exception("Command Failed",
+                        "Command: " + command_name +
+                        " Exitcode: " + str(exit_status) +
+                        " Message: " + tails['stdout'] +
+                        " Error: " + str(tails['stderr'].splitlines(True))
+                        )
+
+
+def build_batch_script(commands, token):
+    """
+    Chains the commands in one shell script. The output of each command is framed
+    on stdout and stderr by delimiters containing its index and its exit code.
+    The script stops at the first command that fails.
+    """
+    lines = list()
+    for index, command in enumerate(commands):
+        begin = "__PM_" + token + "_BEGIN_" + str(index) + "__"
+        end = "__PM_" + token + "_END_" + str(index) + "_"
+        lines.append("printf '%s\\n' '" + begin + "'; printf '%s\\n' '" + begin + "' >&2")
+        lines.append(command)
+        lines.append("rc=$?; printf '\\n%s%d__\\n' '" + end + "' $rc; printf '\\n%s%d__\\n' '" + end + "' $rc >&2")
+        lines.append("[ $rc -eq 0 ] || exit $rc")
+    return "\n".join(lines) + "\n"
+
+
+def parse_batch_output(output, token, nbr_commands):
+    """
+    Splits the framed output of a batch script, returns a dict index -> (exit code, output).
+    """
+    pattern = re.compile(r"__PM_" + token + r"_BEGIN_(\d+)__\n(.*?)\n__PM_" + token + r"_END_\1_(\d+)__\n", re.DOTALL)
+    results = dict()
+    for match in pattern.finditer(output):
+        index = int(match.group(1))
+        if index < nbr_commands:
+            results[index] = (int(match.group(3)), match.group(2))
+    return results
+
+
+def execute_batch(server, commands, become=False):
+    """
+    Executes all the commands in a single remote script, over one channel.
+    Returns the same dict than execute(), one result per command.
+    """
+    token = uuid.uuid4().hex
+    names = list(commands.keys())
+    script_commands = list()
+    for command_name in names:
+        if become:
+            script_commands.append(become_command(server, commands[command_name]))
+        else:
+            script_commands.append(commands[command_name])
+    script = build_batch_script(script_commands, token)
+    data = {'stdout': list(), 'stderr': list()}
+    with pool.exec_command(server, "sh -c " + shlex.quote(script)) as (stdin, stdout, stderr):
+        for source, chunk in read_channel(stdout.channel):
+            data[source].append(chunk)
+        exit_status = wait_exit_status(stdout.channel)
+    out = b''.join(data['stdout']).decode('utf-8')
+    err = b''.join(data['stderr']).decode('utf-8')
+    outputs = parse_batch_output(out, token, len(names))
+    errors = parse_batch_output(err, token, len(names))
+    result = dict()
+    for index, command_name in enumerate(names):
+        if index not in outputs:
             raise Exception("Command Failed",
                             "Command: " + command_name +
-                            " Exitcode: " + str(stdout.channel.recv_exit_status()) +
-                            " Message: " + stdout.read().decode('utf-8') +
-                            " Error: " + str(stderr.readlines())
+                            " Exitcode: " + str(exit_status) +
+                            " Message: batch script interrupted" +
+                            " Error: " + str(err.splitlines(True))
                             )
-        else:
-            result[command_name] = stdout.read().decode('utf-8').replace('\n', '')
-            if result[command_name] == '':
-                result[command_name] = 'OK'
-
-        client.close()
+        command_status, output = outputs[index]
+        if command_status != 0:
+            error = errors.get(index, (command_status, ''))[1]
+            raise Exception("Command Failed",
+                            "Command: " + command_name +
+                            " Exitcode: " + str(command_status) +
+                            " Message: " + output +
+                            " Error: " + str(error.splitlines(True))
+                            )
+        result[command_name] = format_output(output)
     return result
 
 
-def execute_copy(server, src, dest, put=True, become=False):
-    result = dict()
-    client = connection(server)
-    ftp_client = client.open_sftp()
+def remote_sha256(server, path, become=False):
+    """
+    Returns the sha256 of a remote file, or None if it cannot be read.
+    """
     try:
-        if put:
-            if become:
-                if server.become:
-                    ftp_client.put(src, os.path.basename(dest))
+        response = execute(server, {"sha256": "sha256sum " + shlex.quote(path)}, become=become)
+    except Exception:
+        logger.debug("Cannot get the sha256 of " + str(path) + " on " + str(server.name), exc_info=True)
+        return None
+    return response['sha256'].split(' ')[0]
+
+
+def execute_copy_delta(server, src, dest, become=False, stats=None):
+    """
+    Uploads only the blocks of src which are not already in the remote file dest.
+    Returns None if the remote file cannot be patched, the file must then be copied entirely.
+    The cipher of the upload is set in the dict stats.
+    """
+    size = os.path.getsize(src)
+    if size < settings.SSH_DELTA_MIN_SIZE:
+        return None
+    block_size = delta_transfer.block_size_for(size)
+    try:
+        response = execute(server, {"signature": delta_transfer.signature_command(dest, block_size)}, become=become)
+        table = delta_transfer.parse_signature(response['signature'])
+    except Exception:
+        logger.debug("Cannot get the signature of " + str(dest) + " on " + str(server.name), exc_info=True)
+        return None
+    if not table:
+        return None
+    delta_name = os.path.basename(dest) + ".pm-delta"
+    with get_tmp_dir('delta') as tmp_dir:
+        with open(src, 'rb') as f:
+            data = f.read()
+        with open(tmp_dir + delta_name, 'wb') as f:
+            literal_bytes = delta_transfer.compute_delta(data, table, block_size, f)
+        if literal_bytes is None:
+            logger.debug("Too many changes in " + str(dest) + " for a delta transfer on " + str(server.name))
+            return None
+        sha256 = hashlib.sha256(data).hexdigest()
+        del data
+        sent = os.path.getsize(tmp_dir + delta_name)
+        with pool.client(server) as client:
+            set_transfer_cipher(stats, client)
+            ftp_client = open_sftp(client)
+            try:
+                ftp_client.put(tmp_dir + delta_name, delta_name)
+            finally:
+                ftp_client.close()
+    try:
+        execute(server, {"patch": delta_transfer.patch_command(dest, delta_name, block_size, sha256)}, become=become)
+    except Exception:
+        logger.warning("Delta transfer of " + str(dest) + " failed on " + str(server.name), exc_info=True)
+        return None
+    logger.debug("Delta transfer of " + str(dest) + " on " + str(server.name) + " : " + str(sent) +
+                 " bytes sent for " + str(size) + " bytes, " + str(literal_bytes) + " bytes changed")
+    return {'copy': "OK", 'delta': {'sent': sent, 'size': size}}
+
+
+def copy_file(server, src, dest, put=True, become=False, stats=None):
+    """
+    The cipher of the transfer is set in the dict stats.
+    """
+    result = dict()
+    with pool.client(server) as client:
+        set_transfer_cipher(stats, client)
+        ftp_client = open_sftp(client)
+        try:
+            if put:
+                if become:
+                    if server.become:
+                        ftp_client.put(src, os.path.basename(dest))
+                    else:
+                        raise Exception("Server cannot become", server.name)
                 else:
-                    raise Exception("Server cannot become", server.name)
+                    ftp_client.put(src, dest)
             else:
-                ftp_client.put(src, dest)
-        else:
-            ftp_client.get(dest, src)
-    except Exception as e:
-        raise Exception("Command scp Failed",
-                        " Message: " + str(e)
-                        )
+                ftp_client.get(dest, src)
+        except Exception as e:
+            raise Exception("Command scp Failed",
+                            " Message: " + str(e)
+                            )
+        finally:
+            ftp_client.close()
     result['copy'] = "OK"
     if become:
         if server.become:
             commands = {"mv": "mv " + os.path.basename(dest) + " " + dest}
             result['mv'] = execute(server, commands, become=True)
-    ftp_client.close()
-    client.close()
     return result
+
+
+def set_transfer_cipher(stats, client):
+    if stats is not None:
+        stats['cipher'] = client.get_transport().local_cipher
+
+
+def execute_copy(server, src, dest, put=True, become=False, skip_identical=False, delta=False):
+    """
+    Copies a file with SFTP. With skip_identical, the upload is skipped if the remote file
+    has the same sha256, the result is then {'copy': 'Unchanged'}.
+    With delta, only the blocks which changed are sent, if the remote file exists.
+    Sends the signal copy_done with the statistics of the upload.
+    """
+    if not put:
+        return copy_file(server, src, dest, put=False, become=become)
+    start = time.monotonic()
+    result = None
+    stats = dict()
+    if skip_identical and (server.become or not become):
+        if remote_sha256(server, dest, become=become) == sha256_file(src):
+            logger.debug(str(dest) + " is unchanged on " + str(server.name) + ", upload skipped")
+            result = {'copy': "Unchanged"}
+            method = 'Unchanged'
+            sent = 0
+    if result is None and delta and (server.become or not become):
+        result = execute_copy_delta(server, src, dest, become=become, stats=stats)
+        if result is not None:
+            method = 'Delta'
+            sent = result['delta']['sent']
+    if result is None:
+        result = copy_file(server, src, dest, put=True, become=become, stats=stats)
+        method = 'Full'
+        sent = os.path.getsize(src)
+    copy_done.send(sender=server.__class__, server=server, dest=dest, size=os.path.getsize(src), sent=sent,
+                   duration=time.monotonic() - start, method=method, cipher=stats.get('cipher'))
+    return result
+
+
+def run_on_server(function, server):
+    try:
+        return function(server)
+    finally:
+        # Each thread opens its own database connection.
+        connections.close_all()
+
+
+async def run_with_limits(function, server, semaphore, executor, timeout):
+    """
+    The timer starts with the thread : the semaphore and the executor have the same size, and after a timeout
+    the semaphore is released only when the thread ends, the work in a thread cannot be interrupted.
+    """
+    await semaphore.acquire()
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(executor, run_on_server, function, server)
+    try:
+        result = await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        logger.error("Timeout on server " + str(server.name) + " after " + str(timeout) + "s")
+        future.add_done_callback(lambda done: semaphore.release())
+        return server, {'status': False, 'errors': "Timeout after " + str(timeout) + "s"}
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda done: semaphore.release())
+        raise
+    except Exception as e:
+        semaphore.release()
+        logger.exception("Error on server " + str(server.name))
+        return server, {'status': False, 'errors': str(e)}
+    else:
+        semaphore.release()
+        return server, {'status': True, 'result': result}
+
+
+async def create_fan_out_tasks(function, servers, concurrency, executor, timeout):
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    return [loop.create_task(run_with_limits(function, server, semaphore, executor, timeout)) for server in servers]
+
+
+def fan_out(servers, function, concurrency=None, timeout=None):
+    """
+    Calls function(server) on all the servers at once, at most 'concurrency' at the same time,
+    each call is limited to 'timeout' seconds.
+    Yields (server, response) as soon as each server is finished, response is
+    {'status': True, 'result': ...} or {'status': False, 'errors': ...}.
+    A call after its timeout keeps its thread until it ends (SSH_CONNECT_TIMEOUT, SSH_COMMAND_TIMEOUT),
+    fan_out returns when all the threads are finished.
+    """
+    servers = list(servers)
+    if not servers:
+        return
+    if concurrency is None:
+        concurrency = settings.SSH_FAN_OUT_CONCURRENCY
+    if timeout is None:
+        timeout = settings.SSH_FAN_OUT_TIMEOUT
+    concurrency = max(1, min(concurrency, len(servers)))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    tasks = list()
+    try:
+        tasks = loop.run_until_complete(create_fan_out_tasks(function, servers, concurrency, executor, timeout))
+        for task in asyncio.as_completed(tasks):
+            yield loop.run_until_complete(task)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        executor.shutdown(wait=True)
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def execute_fleet(servers, commands, become=False, batch=False, concurrency=None, timeout=None):
+    """
+    Executes the same commands on a list of servers in parallel.
+    Yields (server, response) as soon as each server is finished.
+    """
+    def function(server):
+        return execute(server, commands, become=become, batch=batch)
+    return fan_out(servers, function, concurrency=concurrency, timeout=timeout)
+
+
+def distribute(servers, src, dest, become=False, skip_identical=True, delta=False, concurrency=None, timeout=None):
+    """
+    Uploads the same file on several servers in parallel.
+    Yields (server, response) as soon as each server is finished, the result of the response
+    contains the result of execute_copy(), the duration and the throughput in bytes per second.
+    """
+    size = os.path.getsize(src)
+
+    def function(server):
+        start = time.monotonic()
+        result = execute_copy(server, src, dest, become=become, skip_identical=skip_identical, delta=delta)
+        duration = time.monotonic() - start
+        return {'copy': result,
+                'duration': duration,
+                'throughput': int(size / duration) if duration else None}
+    return fan_out(servers, function, concurrency=concurrency, timeout=timeout)
@@ -1,11 +1,23 @@
-import importlib
+import random
+import re
 import reprlib
+from datetime import timedelta
+from functools import wraps
 
-from celery import task
+from celery import group, task
+from celery.exceptions import Retry
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
-from .models import Probe, Job
+from . import archive
+from .exceptions import ProbeBusyError
+from .models import Probe, ProbeHealthSample, ProbeLock, ProbeStatus, Job
 from .notifications import send_notification
+from .registry import registry
+from .ssh import fan_out, is_transient
 
 logger = get_task_logger(__name__)
 
@@ -13,24 +25,95 @@ repr_instance = reprlib.Repr()
 repr_instance.maxstring = 200
 
 
-@task
-def deploy_rules(probe_name):
-    job = Job.create_job('deploy_rules', probe_name)
-    probe = Probe.get_by_name(probe_name)
+def probe_lock(function):
+    """
+    Runs the task at most once at the same time on a probe. The same task on the same probe returns the job
+    already in progress instead of doing the work again, another task waits for the end of the task in progress.
+    """
+    @wraps(function)
+    def wrapper(probe_name, *args, **kwargs):
+        try:
+            lock, job = ProbeLock.acquire(function.__name__, probe_name)
+        except ProbeBusyError as e:
+            Job.create_job(function.__name__, probe_name).update_job(e.message, 'Error')
+            return {"message": "Error for probe " + str(probe_name), "exception": e.message}
+        if lock is None:
+            logger.info(function.__name__ + " already in progress on the probe " + str(probe_name))
+            return {"message": "Probe " + str(probe_name) + " " + function.__name__ + " already in progress",
+                    "job": job.id if job else None}
+        try:
+            return function(probe_name, *args, **kwargs)
+        finally:
+            lock.release()
+    return wrapper
+
+
+def retry_countdown(retries):
+    """
+    Exponential backoff with jitter : between the half and the whole of TASK_RETRY_BACKOFF * 2^retries seconds,
+    at most TASK_RETRY_BACKOFF_MAX, the retries of the tasks failed at the same time are spread.
+    """
+    backoff = min(settings.TASK_RETRY_BACKOFF_MAX, settings.TASK_RETRY_BACKOFF * 2 ** retries)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def retry_transient(current_task, job, error, transient):
+    """
+    Retries the task later in the same job, if the error is transient and the retry budget of the task
+    (max_retries) is not spent. Returns for a permanent error or a direct call, the task fails at once.
+    """
+    request = current_task.request
+    if not transient or request.called_directly or request.retries >= current_task.max_retries:
+        return
+    countdown = retry_countdown(request.retries)
+    job.result = "Attempt " + str(job.attempts) + " failed : " + repr_instance.repr(str(error)) + \
+                 ", retry in " + str(int(countdown)) + "s"
+    job.save(update_fields=['result'])
+    logger.warning(current_task.name + " : " + job.result)
+    kwargs = dict(request.kwargs or {})
+    kwargs['job_id'] = job.id
+    raise current_task.retry(args=request.args, kwargs=kwargs, countdown=countdown)
+
+
+def with_output(job, message):
+    """
+    The message after the output of the commands streamed in the result of the job.
+    """
+    if not job.result:
+        return message
+    return (job.result + '\n' + message)[-settings.JOB_RESULT_MAX_SIZE:]
+
+
+@task(max_retries=settings.TASK_MAX_RETRIES)
+@probe_lock
+def deploy_rules(probe_name, force=False, job_id=None):
+    """
+    Deploys the rules and reloads the probe, unless the rules did not change since the last deployment
+    (same hash of the enabled rules). force deploys even if the rules did not change.
+    """
+    job = Job.create_job('deploy_rules', probe_name, job_id)
+    probe = registry.get_by_name(probe_name)
     if probe is None:
         job.update_job("Error - probe is None - param id not set : " + str(probe_name), 'Error')
         return {"message": "Error - probe is None - param id not set : " + str(probe_name)}
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_name(probe_name)
     try:
+        rules_hash = probe.get_rules_hash()
+        if not force and rules_hash is not None and rules_hash == probe.rules_hash:
+            job.update_job('No-op, rules unchanged since the last deployment (' + str(probe.rules_updated_date) +
+                           '), nothing deployed', 'Completed')
+            return {"message": "Probe " + probe.name + ' rules unchanged'}
         response_deploy_rules = probe.deploy_rules()
+        if response_deploy_rules['status'] and response_deploy_rules.get('unchanged'):
+            probe.set_rules_hash(rules_hash)
+            job.update_job('Rules unchanged, nothing deployed', 'Completed')
+            return {"message": "Probe " + probe.name + ' rules unchanged'}
         response_reload = probe.reload()
         if response_deploy_rules['status'] and response_reload['status']:
+            probe.set_rules_hash(rules_hash)
             job.update_job('Deployed rules successfully', 'Completed')
         elif not response_deploy_rules['status']:
+            retry_transient(deploy_rules, job, response_deploy_rules.get('errors'),
+                            response_deploy_rules.get('transient'))
             if 'errors' in response_deploy_rules:
                 job.update_job('Error during the rules deployed',
                                'Error: ' + str(probe_name) + " - " +
@@ -43,31 +126,31 @@ def deploy_rules(probe_name):
                 logger.error("task - deploy_rules : " + str(probe_name))
                 return {"message": "Error for probe " + str(probe.name) + " to deploy rules", "exception": " "}
         elif not response_reload['status']:
+            retry_transient(deploy_rules, job, response_reload['errors'], response_reload.get('transient'))
             job.update_job('Error during the rules deployed',
                            'Error: ' + str(probe_name) + repr_instance.repr(response_reload['errors']))
             logger.error("task - deploy_rules : " + str(probe_name) + " - " + str(response_reload['errors']))
             return {"message": "Error for probe " + str(probe.name) + " to deploy rules",
                     "exception": str(response_reload['errors'])}
+    except Retry:
+        raise
     except Exception as e:
         logger.exception('Error during the rules deployed')
+        retry_transient(deploy_rules, job, e, is_transient(e))
         job.update_job(repr_instance.repr(e), 'Error')
         send_notification("Probe " + str(probe.name), str(e))
         return {"message": "Error for probe " + str(probe.name) + " to deploy rules", "exception": str(e)}
     return {"message": "Probe " + probe.name + ' deployed rules successfully'}
 
 
-@task
-def reload_probe(probe_name):
-    job = Job.create_job('reload_probe', probe_name)
-    probe = Probe.get_by_name(probe_name)
+@task(max_retries=settings.TASK_MAX_RETRIES)
+@probe_lock
+def reload_probe(probe_name, job_id=None):
+    job = Job.create_job('reload_probe', probe_name, job_id)
+    probe = registry.get_by_name(probe_name)
     if probe is None:
         job.update_job("Error - probe is None - param id not set : " + str(probe_name), 'Error')
         return {"message": "Error - probe is None - param id not set : " + str(probe_name)}
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_name(probe_name)
     if probe.scheduled_rules_deployment_enabled:
         try:
             response = probe.reload()
@@ -76,11 +159,15 @@ def reload_probe(probe_name):
                 logger.info("task - reload_probe : " + str(probe_name))
                 return {"message": "Probe " + str(probe.name) + " reloaded successfully"}
             else:
+                retry_transient(reload_probe, job, response['errors'], response.get('transient'))
                 job.update_job(repr_instance.repr(response['errors']), 'Error')
                 return {"message": "Error for probe " + str(probe.name) + " to reload",
                         "exception": str(response['errors'])}
+        except Retry:
+            raise
         except Exception as e:
             logger.exception("Error for probe to reload")
+            retry_transient(reload_probe, job, e, is_transient(e))
             job.update_job(repr_instance.repr(e), 'Error')
             send_notification("Probe " + str(probe.name), str(e))
             return {"message": "Error for probe " + str(probe.name) + " to reload", "exception": str(e)}
@@ -90,96 +177,272 @@ def reload_probe(probe_name):
         return {"message": probe.name + " not enabled to reload"}
 
 
-@task
-def install_probe(probe_name):
-    job = Job.create_job('install_probe', probe_name)
-    probe = Probe.get_by_name(probe_name)
+@task(max_retries=settings.TASK_MAX_RETRIES)
+@probe_lock
+def install_probe(probe_name, job_id=None):
+    job = Job.create_job('install_probe', probe_name, job_id)
+    probe = registry.get_by_name(probe_name)
     if probe is None:
         job.update_job("Error - probe is None - param id not set : " + str(probe_name), 'Error')
         return {"message": "Error - probe is None - param id not set : " + str(probe_name)}
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_name(probe_name)
+    probe.job = job
     try:
+        rules_hash = probe.get_rules_hash()
         response_install = probe.install()
         response_deploy_conf = probe.deploy_conf()
         response_deploy_rules = probe.deploy_rules()
         response_start = probe.start()
     except Exception as e:
         logger.exception("Error for probe to install")
+        retry_transient(install_probe, job, e, is_transient(e))
         job.update_job(repr_instance.repr(e), 'Error')
         send_notification("Error for probe " + str(probe.name), str(e))
         return {"message": "Error for probe " + str(probe.name) + " to install", "exception": str(e)}
     if response_install['status'] and response_start['status'] and response_deploy_conf['status'] \
        and response_deploy_rules['status']:
-        job.update_job('Probe ' + str(probe.name) + ' installed successfully', 'Completed')
+        probe.set_rules_hash(rules_hash)
+        job.update_job(with_output(job, 'Probe ' + str(probe.name) + ' installed successfully'), 'Completed')
         return {"message": "Probe " + str(probe.name) + " installed successfully"}
     else:
-        job.update_job("Error for probe " + str(probe.name) + " to install", 'Error')
+        probe.set_rules_hash(None)
+        job.update_job(with_output(job, "Error for probe " + str(probe.name) + " to install"), 'Error')
         return {"message": "Error for probe " + str(probe.name) + " to install"}
 
 
-@task
-def update_probe(probe_name):
-    job = Job.create_job('update_probe', probe_name)
-    probe = Probe.get_by_name(probe_name)
+@task(max_retries=settings.TASK_MAX_RETRIES)
+@probe_lock
+def update_probe(probe_name, job_id=None):
+    job = Job.create_job('update_probe', probe_name, job_id)
+    probe = registry.get_by_name(probe_name)
     if probe is None:
         job.update_job("Error - probe is None - param id not set : " + str(probe_name), 'Error')
         return {"message": "Error - probe is None - param id not set : " + str(probe_name)}
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_name(probe_name)
+    probe.job = job
     try:
         response_update = probe.update()
         response_restart = probe.restart()
     except Exception as e:
         logger.exception("Error for probe to install")
+        retry_transient(update_probe, job, e, is_transient(e))
         job.update_job(repr_instance.repr(e), 'Error')
         send_notification("Error for probe " + str(probe.name), str(e))
         return {"message": "Error for probe " + str(probe.name) + " to install", "exception": str(e)}
     if response_update['status'] and response_restart['status']:
-        job.update_job(response_update + response_restart, 'Completed')
+        job.update_job(with_output(job, "Probe " + str(probe.name) + " updated successfully"), 'Completed')
         return {"message": "Probe " + str(probe.name) + " updated successfully"}
     else:
-        job.update_job("Error for probe " + str(probe.name) + " to update", 'Error')
+        job.update_job(with_output(job, "Error for probe " + str(probe.name) + " to update"), 'Error')
         return {"message": "Error for probe " + str(probe.name) + " to update"}
 
 
-@task
-def check_probe(probe_name):
-    job = Job.create_job('check_probe', probe_name)
-    probe = Probe.get_by_name(probe_name)
+# Checked again at the next interval, one retry is enough.
+@task(max_retries=1)
+def check_probe(probe_name, job_id=None, samples=None):
+    """
+    Checks the health of the probe. The state seen by the last check is in the cache (ProbeStatus.last_check_running),
+    a job is written only for an error or when the probe starts or stops running since the last check.
+    samples collects the health sample instead of saving it, see Probe.refresh_health().
+    """
+    probe = registry.get_by_name(probe_name)
     if probe is None:
-        job.update_job("Error - probe is None - param id not set : " + str(probe_name), 'Error')
+        Job.create_job('check_probe', probe_name, job_id).update_job(
+            "Error - probe is None - param id not set : " + str(probe_name), 'Error')
         return {"message": "Error - probe is None - param id not set : " + str(probe_name)}
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_name(probe_name)
     if probe.installed:
-        try:
-            response_status = probe.status()
-        except Exception as e:
-            logger.exception("Error for probe to check status")
-            job.update_job(repr_instance.repr(e), 'Error')
-            send_notification("Error for probe " + str(probe.name), str(e))
-            return {"message": "Error for probe " + str(probe.name) + " to check status", "exception": str(e)}
-        if response_status:
-            if 'active (running)' in response_status:
-                job.update_job("OK probe " + str(probe.name) + " is running", 'Completed')
-                return {"message": "OK probe " + str(probe.name) + " is running"}
-            else:
-                job.update_job("KO probe " + str(probe.name) + " is not running", 'Completed')
-                send_notification("probe KO", "Probe " + str(probe.name) + " is not running")
-                return {"message": "KO probe " + str(probe.name) + " is not running"}
+        last_status = probe.last_status()
+        last_running = last_status.last_check_running if last_status else None
+        health = probe.refresh_health(samples=samples)
+        ProbeStatus.store_check(probe, None if health.error else health.running)
+        if health.error:
+            job = Job.create_job('check_probe', probe_name, job_id)
+            retry_transient(check_probe, job, health.error, health.transient)
+            job.update_job(repr_instance.repr(health.error), 'Error')
+            send_notification("Error for probe " + str(probe.name), health.error)
+            return {"message": "Error for probe " + str(probe.name) + " to check status", "exception": health.error}
+        # The job of a retry is always finished.
+        changed = job_id is not None or last_running is None or last_running != health.running
+        if health.running:
+            if changed:
+                Job.create_job('check_probe', probe_name, job_id).update_job(
+                    "OK probe " + str(probe.name) + " is running, uptime " + health.uptime_display, 'Completed')
+            return {"message": "OK probe " + str(probe.name) + " is running"}
         else:
-            job.update_job("Error for probe " + str(probe.name) + " to check status", 'Error')
-            return {"message": "Error for probe " + str(probe.name) + " to check status"}
+            if changed:
+                Job.create_job('check_probe', probe_name, job_id).update_job(
+                    "KO probe " + str(probe.name) + " is not running : " + str(health), 'Completed')
+            send_notification("probe KO", "Probe " + str(probe.name) + " is not running")
+            return {"message": "KO probe " + str(probe.name) + " is not running"}
     else:
-        job.update_job("Probe " + str(probe.name) + " not installed", 'Completed')
         return {"message": "Probe " + str(probe.name) + " not installed"}
+
+
+@task
+def refresh_probes_status():
+    """
+    Refreshes in parallel the cached health of the installed probes not checked since PROBE_STATUS_TTL.
+    """
+    limit = timezone.now() - timedelta(seconds=settings.PROBE_STATUS_TTL)
+    probes = registry.filter(Q(cached_status__isnull=True) | Q(cached_status__updated__lt=limit), installed=True)
+    samples = list()
+    for probe, response in fan_out(probes, lambda probe: probe.health()):
+        if response['status']:
+            ProbeStatus.store(probe, response['result'])
+            samples.append(ProbeHealthSample.from_health(probe, response['result']))
+    ProbeHealthSample.objects.bulk_create(samples)
+    return {"message": str(len(samples)) + " probes refreshed"}
+
+
+@task
+def purge_probe_health_samples():
+    deleted = ProbeHealthSample.purge()
+    return {"message": str(deleted) + " health samples deleted"}
+
+
+@task
+def archive_jobs():
+    archived = archive.archive_jobs()
+    return {"message": str(archived) + " jobs archived"}
+
+
+@task
+def restore_jobs(start=None, end=None, name=None, probe=None, status=None):
+    """
+    Restores the archived jobs created between the days start and end (YYYY-MM-DD) included.
+    """
+    restored = archive.restore_jobs(start=parse_date(start) if start else None, end=parse_date(end) if end else None,
+                                    name=name, probe=probe, status=status)
+    return {"message": str(restored) + " jobs restored"}
+
+
+def is_failed(response):
+    return 'exception' in response or response.get('message', '').startswith(('Error', 'KO'))
+
+
+def select_probes(probe_type=None, server=None, tag=None):
+    """
+    Returns the names of the probes of this type, on this server (name) and with this tag.
+    """
+    probes = Probe.objects.all()
+    if probe_type:
+        probes = probes.filter(type__iexact=probe_type)
+    if server:
+        probes = probes.filter(server__name=server)
+    if tag:
+        probes = probes.filter(tags__iregex=r'(^|,)\s*' + re.escape(tag) + r'\s*(,|$)')
+    return list(probes.order_by('name').values_list('name', flat=True))
+
+
+FLEET_ACTIONS = {
+    'deploy_rules': deploy_rules,
+    'check_probe': check_probe,
+}
+
+
+@task
+def fleet_chunk(job_id, action, probe_names):
+    """
+    Runs the action on the probes one after the other, and adds each response in the fleet job.
+    The health samples of the checks are saved together at the end.
+    """
+    samples = list()
+    kwargs = {'samples': samples} if action == 'check_probe' else {}
+    try:
+        for probe_name in probe_names:
+            try:
+                response = FLEET_ACTIONS[action](probe_name, **kwargs)
+            except Exception as e:
+                logger.exception("Error for probe " + str(probe_name) + " in the fleet job " + str(job_id))
+                response = {"message": "Error for probe " + str(probe_name), "exception": str(e)}
+            Job.record_fleet_result(job_id, probe_name, response, is_failed(response))
+    finally:
+        ProbeHealthSample.objects.bulk_create(samples)
+
+
+def split_waves(probe_names, canary_names, canary_size, wave_size):
+    """
+    Returns the list of the waves of a rollout, the first one is the canary : the probes with the canary tag,
+    or else the first probes.
+    """
+    canary = [name for name in probe_names if name in canary_names][:canary_size] or probe_names[:canary_size]
+    others = [name for name in probe_names if name not in canary]
+    wave_size = max(1, wave_size)
+    waves = [others[i:i + wave_size] for i in range(0, len(others), wave_size)]
+    if canary:
+        waves.insert(0, canary)
+    return waves
+
+
+def deploy_and_check(probe):
+    """
+    Returns (response, failed) of the deployment of the rules on the probe, followed by a check.
+    """
+    response = deploy_rules(probe.name)
+    if is_failed(response):
+        return response, True
+    response_check = check_probe(probe.name)
+    return {'deploy_rules': response, 'check_probe': response_check}, is_failed(response_check)
+
+
+def rollout_rules(job, probe_names, concurrency):
+    """
+    Deploys the rules wave after wave : the ROLLOUT_CANARY_SIZE canary probes, then waves of ROLLOUT_WAVE_SIZE
+    probes, at most 'concurrency' at the same time, each probe is checked after the deployment.
+    Stops if a canary fails, or if the failure rate of the probes done is above ROLLOUT_MAX_FAILURE_RATE.
+    A probe without model, or not done after ROLLOUT_PROBE_TIMEOUT, is failed. The next wave starts only when
+    the deployments of the wave are finished, even after their timeout.
+    """
+    canary_names = set(select_probes(tag=settings.ROLLOUT_CANARY_TAG))
+    waves = split_waves(probe_names, canary_names, settings.ROLLOUT_CANARY_SIZE, settings.ROLLOUT_WAVE_SIZE)
+    done = 0
+    failed = 0
+    for index, wave in enumerate(waves):
+        probes = registry.filter(name__in=wave)
+        found = set(probe.name for probe in probes)
+        for probe_name in wave:
+            if probe_name not in found:
+                Job.record_fleet_result(job.id, probe_name, {"message": "Error - probe is None : " + probe_name},
+                                        True)
+                done += 1
+                failed += 1
+        for probe, response in fan_out(probes, deploy_and_check, concurrency=concurrency,
+                                       timeout=settings.ROLLOUT_PROBE_TIMEOUT):
+            if response['status']:
+                result, probe_failed = response['result']
+            else:
+                result, probe_failed = {"message": "Error for probe " + str(probe.name),
+                                        "exception": response['errors']}, True
+            Job.record_fleet_result(job.id, probe.name, result, probe_failed)
+            done += 1
+            if probe_failed:
+                failed += 1
+        canary = index == 0 and settings.ROLLOUT_CANARY_SIZE > 0
+        if failed and (canary or failed / done > settings.ROLLOUT_MAX_FAILURE_RATE):
+            reason = "Rollout stopped after the wave " + str(index + 1) + "/" + str(len(waves)) + " : " + \
+                     str(failed) + "/" + str(done) + " probes failed"
+            Job.stop_fleet_job(job.id, reason, [name for others in waves[index + 1:] for name in others])
+            send_notification("Rollout stopped", reason)
+            return {"message": reason, "job": job.id}
+    return {"message": "Rules deployed on " + str(done) + " probes in " + str(len(waves)) + " waves", "job": job.id}
+
+
+@task
+def run_on_fleet(action, probe_type=None, server=None, tag=None, concurrency=None, rollout=False):
+    """
+    Runs deploy_rules or check_probe on the selected probes, with a group of at most 'concurrency' tasks
+    each one on a part of the probes. The responses of all the probes are in one Job.
+    With rollout, the rules are deployed in waves, see rollout_rules().
+    """
+    if action not in FLEET_ACTIONS:
+        return {"message": "Error - unknown action : " + str(action)}
+    probe_names = select_probes(probe_type=probe_type, server=server, tag=tag)
+    selection = 'type=' + str(probe_type or '*') + ' server=' + str(server or '*') + ' tag=' + str(tag or '*')
+    if rollout and action == 'deploy_rules':
+        job = Job.create_fleet_job(action + '_rollout', selection, probe_names)
+        return rollout_rules(job, probe_names, concurrency or settings.ROLLOUT_CONCURRENCY)
+    if concurrency is None:
+        concurrency = settings.FLEET_CONCURRENCY
+    job = Job.create_fleet_job(action + '_fleet', selection, probe_names)
+    chunks = [probe_names[i::concurrency] for i in range(min(concurrency, len(probe_names)))]
+    if chunks:
+        group(fleet_chunk.s(job.id, action, chunk) for chunk in chunks).apply_async()
+    return {"message": str(len(probe_names)) + " probes selected for " + action, "job": job.id}
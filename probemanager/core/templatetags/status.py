@@ -1,9 +1,8 @@
-import importlib
 import logging
 
 from django import template
 
-from core.models import Probe
+from core.models import ProbeStatus
 
 logger = logging.getLogger(__name__)
 register = template.Library()
@@ -11,16 +10,13 @@ register = template.Library()
 
 @register.filter
 def status(probe_id):
-    probe = Probe.get_by_id(probe_id)
-    if probe is None:  # pragma: no cover
-        return {"message": "Error - probe is None - param id not set : " + str(probe_id)}
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(probe_id)
-    response = probe.status()
-    if 'running' in response:
+    """
+    Color of the last cached health of the probe, without remote call.
+    """
+    probe_status = ProbeStatus.objects.filter(probe_id=probe_id).first()
+    if probe_status is None:
+        return 'secondary'
+    if probe_status.health.running:
         return 'success'
     else:
         return 'danger'
@@ -0,0 +1,80 @@
+"""
+Benchmarks of the SSH layer, not in the tests (runtests.py) : timings depend on the machine.
+PM_BENCH_HOSTS=100 PM_BENCH_LATENCY=0.2 venv/bin/python probemanager/manage.py test core.tests.benchmark_ssh \
+--settings=probemanager.settings.dev
+"""
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.test import TestCase
+
+from core.models import Probe
+from core.ssh import connection, distribute, execute, execute_fleet
+from core.tasks import check_probe
+from core.tests.sshserver import StandInServersMixin
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+HOSTS = int(os.environ.get('PM_BENCH_HOSTS', 10))
+LATENCY = float(os.environ.get('PM_BENCH_LATENCY', 0.05))
+ROUNDS = int(os.environ.get('PM_BENCH_ROUNDS', 50))
+
+
+class SshBenchmark(StandInServersMixin, TestCase):
+    """
+    Measures the SSH layer against local stand-in servers, one per simulated host.
+    """
+    fixtures = ['init']
+    hosts = HOSTS
+    latency = LATENCY
+    key_file = 'ssh_keys/benchmark_rsa'
+
+    def report(self, name, value, unit):
+        logger.info('[benchmark] ' + name + ': ' + str(round(value, 3)) + ' ' + unit +
+                    ' (hosts=' + str(HOSTS) + ', latency=' + str(LATENCY) + 's)')
+
+    def test_connections_per_second(self):
+        rounds = max(1, ROUNDS // 5)
+        start = time.monotonic()
+        for i in range(rounds):
+            connection(self.servers[0]).close()
+        self.report('connections per second', rounds / (time.monotonic() - start), 'conn/s')
+
+    def test_commands_per_second(self):
+        server = self.servers[0]
+        execute(server, {'hostname': "hostname"})
+        start = time.monotonic()
+        for i in range(ROUNDS):
+            execute(server, {'hostname': "hostname"})
+        self.report('commands per second', ROUNDS / (time.monotonic() - start), 'cmd/s')
+
+    def test_fleet_fan_out(self):
+        list(execute_fleet(self.servers, {'start': "service suricata start"}, become=True))
+        # The connections are already in the pool, only the commands are measured.
+        start = time.monotonic()
+        list(execute_fleet(self.servers, {'status': "service suricata status"}, become=True))
+        self.report('fleet fan-out', time.monotonic() - start, 's')
+
+    def test_distribute(self):
+        list(execute_fleet(self.servers, {'hostname': "hostname"}))
+        start = time.monotonic()
+        list(distribute(self.servers, src=settings.ROOT_DIR + '/LICENSE', dest='/etc/suricata/LICENSE', become=True))
+        self.report('distribution of one file', time.monotonic() - start, 's')
+
+    def test_probe_health(self):
+        probe = Probe.objects.create(name='bench-probe', server=self.servers[0], installed=True)
+        execute(self.servers[0], {'start': "service probe start"}, become=True)
+        start = time.monotonic()
+        probe.health()
+        self.report('probe health', time.monotonic() - start, 's')
+
+    def test_check_probe(self):
+        Probe.objects.create(name='bench-probe', server=self.servers[0], installed=True)
+        execute(self.servers[0], {'start': "service probe start"}, become=True)
+        start = time.monotonic()
+        for i in range(ROUNDS):
+            check_probe('bench-probe')
+        self.report('check_probe', ROUNDS / (time.monotonic() - start), 'checks/s')
@@ -0,0 +1,337 @@
+"""
+Local stand-in SSH server for the tests and the benchmarks, without a real remote host.
+The commands are fake : service, systemctl show, cat, mv, hostname, sha256sum, echo, printf, grep, sudo, sh -c,
+the pipes and the sequences with ';'.
+The files (SFTP, cat, mv) are in a temporary directory.
+"""
+import hashlib
+import os
+import random
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import paramiko
+from django.conf import settings
+
+from core.models import OsSupported, Server, SshKey
+from core.ssh import pool
+
+HOST_KEY = paramiko.RSAKey.generate(2048)
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """
+    SFTP in the root directory of the stand-in server.
+    """
+    def __init__(self, server, stand_in, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.stand_in = stand_in
+
+    def open(self, path, flags, attr):
+        path = self.stand_in.get_path(path)
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StubSFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.stand_in.get_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(self.stand_in.get_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.stand_in.get_path(oldpath), self.stand_in.get_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class StandInServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.stand_in.exec_command, args=(channel, command.decode('utf-8')))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class StandInSshServer:
+    """
+    Listens on address with a random port. latency is added to each command, in seconds,
+    failure_rate is the probability that a command fails, refuse closes the new connections.
+    """
+    def __init__(self, address='127.0.0.1', hostname='stand-in', latency=0, failure_rate=0):
+        self.address = address
+        self.hostname = hostname
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.refuse = False
+        self.services = dict()
+        self.boot = time.monotonic() - 1000
+        self.connections = 0
+        self.commands = 0
+        self.root = tempfile.mkdtemp()
+        self._transports = list()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((address, 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._socket.accept()
+            except OSError:
+                return
+            if self.refuse:
+                sock.close()
+                continue
+            self.connections += 1
+            # Like sshd, without it each small reply waits for the delayed ACK of the client.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(HOST_KEY)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer, self)
+            transport.start_server(server=StandInServerInterface(self))
+            self._transports.append(transport)
+
+    def get_path(self, path):
+        path = os.path.join(self.root, path.lstrip('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def exec_command(self, channel, command):
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            status, stdout, stderr = 1, '', 'Simulated failure\n'
+        else:
+            status, stdout, stderr = self.run(command)
+        channel.sendall(stdout.encode('utf-8'))
+        channel.sendall_stderr(stderr.encode('utf-8'))
+        channel.send_exit_status(status)
+        # The client closes the channel, closing it here could happen before the reply to the exec request.
+        channel.shutdown_write()
+
+    def run(self, command):
+        """
+        Runs a fake command, returns (exit code, stdout, stderr).
+        """
+        try:
+            tokens = shlex.split(command)
+        except ValueError as e:
+            return 2, '', str(e) + '\n'
+        sequences = [[[]]]
+        for token in tokens:
+            if token == '|':
+                sequences[-1].append([])
+            elif token.endswith(';'):
+                if token != ';':
+                    sequences[-1][-1].append(token[:-1])
+                sequences.append([[]])
+            else:
+                sequences[-1][-1].append(token)
+        status, stdout, stderr = 0, '', ''
+        for segments in sequences:
+            output = ''
+            for segment in segments:
+                status, output, error = self.run_segment(segment, output)
+                stderr += error
+            stdout += output
+        return status, stdout, stderr
+
+    def run_segment(self, args, stdin):
+        while args and args[0] == 'sudo':
+            args = [arg for arg in args[1:] if arg != '-S']
+        if not args:
+            return 0, '', ''
+        name = args[0]
+        if name == 'hostname':
+            return 0, self.hostname + '\n', ''
+        elif name == 'sh' and len(args) == 3 and args[1] == '-c':
+            return self.run(args[2])
+        elif name == 'printf' and len(args) == 2:
+            return 0, args[1], ''
+        elif name == 'echo':
+            return 0, ' '.join(args[1:]) + '\n', ''
+        elif name == 'true':
+            return 0, '', ''
+        elif name == 'false':
+            return 1, '', ''
+        elif name == 'grep':
+            lines = [line for line in stdin.splitlines(True) if args[-1] in line]
+            return (0 if lines else 1), ''.join(lines), ''
+        elif name == 'cat' and args[1:] == ['/proc/uptime']:
+            uptime = time.monotonic() - self.boot
+            return 0, '%.2f %.2f\n' % (uptime, uptime), ''
+        elif name == 'cat':
+            try:
+                with open(self.get_path(args[1]), encoding='utf-8') as f:
+                    return 0, f.read(), ''
+            except (OSError, IndexError) as e:
+                return 1, '', 'cat: ' + str(e) + '\n'
+        elif name == 'mv':
+            try:
+                shutil.move(self.get_path(args[1]), self.get_path(args[2]))
+            except (OSError, IndexError) as e:
+                return 1, '', 'mv: ' + str(e) + '\n'
+            return 0, '', ''
+        elif name == 'sha256sum':
+            try:
+                with open(self.get_path(args[1]), 'rb') as f:
+                    return 0, hashlib.sha256(f.read()).hexdigest() + '  ' + args[1] + '\n', ''
+            except (OSError, IndexError) as e:
+                return 1, '', 'sha256sum: ' + str(e) + '\n'
+        elif name == 'service' and len(args) == 3:
+            return self.service(args[1], args[2])
+        elif name == 'systemctl' and len(args) >= 3 and args[1] == 'show':
+            return self.show(args[2])
+        return 127, '', name + ': command not found\n'
+
+    def service(self, name, action):
+        if action in ('start', 'restart', 'reload'):
+            if action != 'reload' or name in self.services:
+                self.services[name] = time.monotonic()
+            return 0, '', ''
+        elif action == 'stop':
+            self.services.pop(name, None)
+            return 0, '', ''
+        elif action == 'status':
+            if name in self.services:
+                since = time.gmtime(time.time() - time.monotonic() + self.services[name])
+                return 0, '● ' + name + '.service\n   Active: active (running) since ' + \
+                          time.strftime('%a %Y-%m-%d %H:%M:%S UTC', since) + '; 1s ago\n', ''
+            return 3, '● ' + name + '.service\n   Active: inactive (dead)\n', ''
+        return 1, '', 'Usage: service ' + name + ' {start|stop|restart|reload|status}\n'
+
+    def show(self, name):
+        if name in self.services:
+            return 0, 'LoadState=loaded\nActiveState=active\nSubState=running\nMainPID=' + \
+                      str(1000 + len(name)) + '\nMemoryCurrent=52428800\nActiveEnterTimestampMonotonic=' + \
+                      str(int((self.services[name] - self.boot) * 1000000)) + '\n', ''
+        return 0, 'LoadState=loaded\nActiveState=inactive\nSubState=dead\nMainPID=0\n' + \
+                  'MemoryCurrent=[not set]\nActiveEnterTimestampMonotonic=0\n', ''
+
+
+def loopback_address(index):
+    """
+    A distinct loopback address for each stand-in server, Server.host is unique. All of 127.0.0.0/8 is local
+    on Linux, elsewhere only 127.0.0.1 : the tests with the stand-in servers are skipped.
+    """
+    if not sys.platform.startswith('linux'):
+        raise unittest.SkipTest('The stand-in servers need the loopback network 127.0.0.0/8 of Linux')
+    return '127.0.' + str(index // 254) + '.' + str(index % 254 + 1)
+
+
+class StandInServersMixin:
+    """
+    TestCase mixin : setUp starts 'hosts' stand-in servers with 'latency', each on its own loopback address,
+    in self.stand_ins, and their Server rows in self.servers. Needs the fixture init.
+    With the fan-out (threads with their own database connection), use it with a TransactionTestCase.
+    """
+    hosts = 3
+    latency = 0
+    key_file = 'ssh_keys/stand_in_rsa'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        paramiko.RSAKey.generate(2048).write_private_key_file(settings.MEDIA_ROOT + "/" + cls.key_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(settings.MEDIA_ROOT + "/" + cls.key_file)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.ssh_key = SshKey.objects.create(name='stand-in', file=self.key_file)
+        self.stand_ins = list()
+        for i in range(self.hosts):
+            stand_in = StandInSshServer(address=loopback_address(i), hostname='stand-in-' + str(i),
+                                        latency=self.latency)
+            stand_in.start()
+            self.stand_ins.append(stand_in)
+            Server.objects.create(name='stand-in-' + str(i),
+                                  host=stand_in.address,
+                                  os=OsSupported.get_by_id(1),
+                                  remote_user='stand-in',
+                                  remote_port=stand_in.port,
+                                  become=True,
+                                  ssh_private_key_file=self.ssh_key)
+        self.servers = list(Server.objects.select_related('os', 'ssh_private_key_file')
+                            .filter(name__startswith='stand-in-').order_by('id'))
+
+    def tearDown(self):
+        for server in self.servers:
+            pool.discard(server)
+        for stand_in in self.stand_ins:
+            stand_in.stop()
@@ -1,14 +1,19 @@
 """ venv/bin/python probemanager/manage.py test core.tests.test_api --settings=probemanager.settings.dev """
+import gzip
+import json
+from datetime import timedelta
+
 from django.contrib.auth.models import User
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.test import APITestCase
 
-from core.models import Configuration, Server
+from core.models import Configuration, Job, Probe, ProbeHealthSample, Server
 
 
 class APITest(APITestCase):
-    fixtures = ['init', 'crontab', 'test-core-secrets']
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
 
     def setUp(self):
         self.client = APIClient()
@@ -29,6 +34,9 @@ class APITest(APITestCase):
         response = self.client.get('/api/v1/core/server/1/test_connection/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data, {'status': True})
+        response = self.client.get('/api/v1/core/server/test_connections/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {server.name: {'status': True}})
 
     def test_configuration(self):
         response = self.client.get('/api/v1/core/configuration/')
@@ -123,3 +131,66 @@ yA5V366AarS/0vGFYUPb800cNsCqkBC6DeeKJ5+PbN+IsbCIwMOq9NSZJq0=
         response = self.client.get('/api/v1/core/sshkey/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['count'], 2)
+
+    def test_job(self):
+        now = timezone.now()
+        for i in range(25):
+            Job.objects.create(name='check_probe', probe='probe' + str(i % 2), status='Completed', result='OK',
+                               created=now - timedelta(minutes=i), completed=now)
+        response = self.client.get('/api/v1/core/job/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertIsNone(response.data['previous'])
+        self.assertIn('result', response.data['results'][0])
+        response_next = self.client.get(response.data['next'])
+        self.assertEqual(len(response_next.data['results']), 5)
+        self.assertIsNone(response_next.data['next'])
+        ids = [job['id'] for job in response.data['results'] + response_next.data['results']]
+        self.assertEqual(ids, list(Job.objects.order_by('-created', '-id').values_list('id', flat=True)))
+
+        response = self.client.get('/api/v1/core/job/', {'fields': 'id,status', 'limit': 5, 'probe': 'probe1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'status'})
+        response = self.client.get('/api/v1/core/job/', {'probe': 'probe1', 'limit': 100,
+                                                          'created_after': (now - timedelta(minutes=10)).isoformat()})
+        self.assertEqual(len(response.data['results']), 5)
+        response = self.client.get('/api/v1/core/job/', {'created_before': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/api/v1/core/job/', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export(self):
+        now = timezone.now()
+        for i in range(5):
+            Job.objects.create(name='check_probe', probe='probe1', status='Completed', result='OK, "' + str(i) + '"',
+                               created=now - timedelta(minutes=i), completed=now)
+        response = self.client.get('/api/v1/core/job/export/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="jobs.ndjson"')
+        jobs = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual(len(jobs), 5)
+        self.assertEqual(jobs[0]['result'], 'OK, "4"')
+        self.assertEqual(jobs[-1]['created'], now.isoformat())
+
+        response = self.client.get('/api/v1/core/job/export/', {'output': 'csv', 'compression': 'gzip',
+                                                                'fields': 'id,result', 'status': 'Completed'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="jobs.csv.gz"')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id,result')
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].endswith(',"OK, ""4"""'))
+        response = self.client.get('/api/v1/core/job/export/', {'output': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        probe = Probe.get_by_id(1)
+        ProbeHealthSample.objects.create(probe=probe, state='running', uptime=10, latency=1.5)
+        response = self.client.get('/api/v1/core/probehealthsample/export/', {'probe': 'probe1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        samples = [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+        self.assertEqual(len(samples), 1)
+        self.assertEqual(samples[0]['probe_name'], 'probe1')
+        self.assertEqual(samples[0]['state'], 'running')
+        response = self.client.get('/api/v1/core/probehealthsample/export/', {'since': (timezone.now() + timedelta(minutes=1)).isoformat()})
+        self.assertEqual(b''.join(response.streaming_content), b'')
@@ -0,0 +1,62 @@
+""" venv/bin/python probemanager/manage.py test core.tests.test_archive --settings=probemanager.settings.dev """
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.archive import archive_days, archive_jobs, archive_path, read_archives, restore_jobs
+from core.models import Job
+
+
+class ArchiveTest(TestCase):
+    fixtures = ['init']
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.old = now - timedelta(days=40)
+        Job.objects.create(name='check_probe', probe='probe1', status='Completed', result='OK',
+                           created=cls.old, completed=cls.old)
+        Job.objects.create(name='check_probe', probe='probe2', status='Error', result='KO',
+                           created=cls.old, completed=cls.old)
+        Job.objects.create(name='deploy_rules', probe='probe1', status='Completed', result='OK',
+                           created=cls.old - timedelta(days=1), completed=None)
+        Job.objects.create(name='install_probe', probe='probe1', status='In progress', created=cls.old)
+        Job.objects.create(name='check_probe', probe='probe1', status='Completed', created=now, completed=now)
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.settings = override_settings(JOB_ARCHIVE_DIR=self.archive_dir)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.archive_dir, ignore_errors=True)
+
+    def test_archive(self):
+        self.assertEqual(archive_days(), [])
+        self.assertEqual(archive_jobs(retention_days=30, batch_size=2), 3)
+        self.assertEqual(Job.objects.count(), 2)
+        self.assertTrue(Job.objects.filter(status='In progress').exists())
+        days = [timezone.localdate(self.old - timedelta(days=1)), timezone.localdate(self.old)]
+        self.assertEqual(archive_days(), days)
+        self.assertTrue(os.path.isfile(archive_path(days[0])))
+        self.assertEqual(archive_jobs(retention_days=30), 0)
+
+        self.assertEqual(len(list(read_archives())), 3)
+        self.assertEqual(len(list(read_archives(start=days[1]))), 2)
+        self.assertEqual(len(list(read_archives(end=days[0]))), 1)
+        self.assertEqual([job['probe'] for job in read_archives(status='Error')], ['probe2'])
+        self.assertEqual(len(list(read_archives(name='check_probe', probe='probe1'))), 1)
+
+        self.assertEqual(restore_jobs(name='check_probe'), 2)
+        self.assertEqual(restore_jobs(), 1)
+        self.assertEqual(restore_jobs(), 0)
+        self.assertEqual(Job.objects.count(), 5)
+        job = Job.objects.get(name='deploy_rules')
+        self.assertEqual(job.created, self.old - timedelta(days=1))
+        self.assertIsNone(job.completed)
+        self.assertEqual(job.result, 'OK')
@@ -0,0 +1,68 @@
+""" venv/bin/python probemanager/manage.py test core.tests.test_delta --settings=probemanager.settings.dev """
+import hashlib
+import io
+import subprocess
+
+from django.test import SimpleTestCase
+
+from core.delta import block_size_for, weak_checksum, strong_checksum, signature_command, patch_command, \
+    parse_signature, compute_delta
+from core.utils import get_tmp_dir
+
+
+class DeltaTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.old = b''.join(('alert tcp any any -> any any (msg:"rule ' + str(i) + '"; sid:' + str(i) +
+                            '; rev:1;)\n').encode('utf-8') for i in range(20000))
+        cls.new = b'alert inserted\n' + cls.old[:400000].replace(b'rule 100;', b'rule 100 changed;') + \
+            cls.old[400100:] + b'tail\n'
+
+    def test_block_size_for(self):
+        self.assertEqual(block_size_for(0), 2048)
+        self.assertEqual(block_size_for(16 * 1024 * 1024), 4096)
+        self.assertEqual(block_size_for(100 * 1024 * 1024 * 1024), 65536)
+
+    def test_rolling_checksum(self):
+        block_size = 4096
+        table = {weak_checksum(self.old[4096:8192]): {strong_checksum(self.old[4096:8192]): 0}}
+        f = io.BytesIO()
+        literal_bytes = compute_delta(b'shifted' + self.old[4096:8192], table, block_size, f)
+        self.assertEqual(literal_bytes, len(b'shifted'))
+        self.assertEqual(f.getvalue(), b'L\x00\x00\x00\x07shiftedC\x00\x00\x00\x00\x00\x00\x00\x01')
+
+    def test_too_many_changes(self):
+        block_size = 2048
+        table = dict()
+        for i in range(len(self.old) // block_size):
+            block = self.old[i * block_size:(i + 1) * block_size]
+            table.setdefault(weak_checksum(block), dict())[strong_checksum(block)] = i
+        # Mostly unknown remotely : the full copy is faster.
+        self.assertIsNone(compute_delta(self.old[:block_size] + self.old.upper(), table, block_size, io.BytesIO()))
+        self.assertIsNone(compute_delta(self.old[:block_size] + b'x' * 1000, table, block_size, io.BytesIO()))
+        self.assertEqual(compute_delta(self.old[:block_size] + b'x' * 100, table, block_size, io.BytesIO()), 100)
+
+    def test_delta_round_trip(self):
+        block_size = block_size_for(len(self.new))
+        with get_tmp_dir('test_delta') as tmp_dir:
+            with open(tmp_dir + 'rules.rules', 'wb') as f:
+                f.write(self.old)
+            output = subprocess.check_output(signature_command('rules.rules', block_size), shell=True, cwd=tmp_dir)
+            table = parse_signature(output.decode('utf-8'))
+            self.assertEqual(len(table), len(self.old) // block_size)
+            with open(tmp_dir + 'rules.delta', 'wb') as f:
+                literal_bytes = compute_delta(self.new, table, block_size, f)
+            self.assertLess(literal_bytes, 3 * block_size)
+            subprocess.check_call(patch_command('rules.rules', 'rules.delta', block_size,
+                                                hashlib.sha256(self.new).hexdigest()), shell=True, cwd=tmp_dir)
+            with open(tmp_dir + 'rules.rules', 'rb') as f:
+                self.assertEqual(f.read(), self.new)
+            with open(tmp_dir + 'rules.delta', 'wb') as f:
+                compute_delta(self.new, table, block_size, f)
+            with self.assertRaises(subprocess.CalledProcessError):
+                subprocess.check_call(patch_command('rules.rules', 'rules.delta', block_size, 'wrong'),
+                                      shell=True, cwd=tmp_dir)
+            with open(tmp_dir + 'rules.rules', 'rb') as f:
+                self.assertEqual(f.read(), self.new)
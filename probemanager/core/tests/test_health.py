@@ -0,0 +1,42 @@
+""" venv/bin/python probemanager/manage.py test core.tests.test_health --settings=probemanager.settings.dev """
+from django.test import SimpleTestCase
+
+from core.health import ProbeHealth, health_command
+
+
+class HealthTest(SimpleTestCase):
+
+    def test_health_command(self):
+        self.assertEqual(health_command('suricata'),
+                         "sh -c 'printf '\"'\"'Uptime='\"'\"'; cat /proc/uptime; systemctl show suricata "
+                         "--property=LoadState,ActiveState,SubState,MainPID,MemoryCurrent,"
+                         "ActiveEnterTimestampMonotonic'")
+        self.assertIn('wc -l', health_command('suricata', 'wc -l < /etc/suricata/rules/deployed.rules'))
+
+    def test_parse(self):
+        health = ProbeHealth.parse("Uptime=1500.25 3000.50\nRulesCount=12345\n\nLoadState=loaded\n"
+                                   "ActiveState=active\nSubState=running\nMainPID=842\nMemoryCurrent=52428800\n"
+                                   "ActiveEnterTimestampMonotonic=1000250000\n")
+        self.assertTrue(health.running)
+        self.assertEqual(str(health), 'active (running)')
+        self.assertEqual(health.uptime, 500)
+        self.assertEqual(health.uptime_display, '0:08:20')
+        self.assertEqual(health.pid, 842)
+        self.assertEqual(health.memory, 52428800)
+        self.assertEqual(health.rules_count, 12345)
+        self.assertEqual(ProbeHealth.from_dict(health.to_dict()).to_dict(), health.to_dict())
+
+    def test_parse_not_running(self):
+        health = ProbeHealth.parse("Uptime=1500.25 3000.50\nRulesCount=\nLoadState=loaded\nActiveState=inactive\n"
+                                   "SubState=dead\nMainPID=0\nMemoryCurrent=18446744073709551615\n"
+                                   "ActiveEnterTimestampMonotonic=0\n")
+        self.assertFalse(health.running)
+        self.assertEqual(str(health), 'inactive (dead)')
+        self.assertIsNone(health.uptime)
+        self.assertEqual(health.uptime_display, 'Unknown')
+        self.assertIsNone(health.pid)
+        self.assertIsNone(health.memory)
+        self.assertIsNone(health.rules_count)
+        self.assertEqual(str(ProbeHealth.parse("LoadState=not-found\nActiveState=inactive\n")), 'not found')
+        self.assertEqual(str(ProbeHealth.parse("")), 'unknown')
+        self.assertEqual(str(ProbeHealth(error='timeout')), 'Failed to get the health : timeout')
@@ -2,10 +2,15 @@
 from datetime import timedelta, datetime
 
 import pytz
+from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-from core.models import OsSupported, Probe, ProbeConfiguration, SshKey, Job, Server, Configuration
+from core.health import ProbeHealth
+from core.models import OsSupported, Probe, ProbeConfiguration, ProbeHealthSample, ProbeStatus, SshKey, Job, Server, \
+    Configuration
+from core.templatetags.status import status
 
 
 class JobTest(TestCase):
@@ -25,6 +30,10 @@ class JobTest(TestCase):
         self.assertEqual(self.job2.status, 'In progress')
         self.job2.update_job('test model', 'Completed')
         self.assertEqual(self.job2.status, 'Completed')
+        self.assertEqual(self.job2.attempts, 1)
+        self.assertEqual(Job.create_job('test2', 'probe1', self.job2.id), self.job2)
+        self.assertEqual(Job.objects.get(id=self.job2.id).attempts, 2)
+        self.assertNotEqual(Job.create_job('test2', 'probe1', 0), self.job2)
         jobs = Job.get_all()
         self.assertTrue(jobs[0].created > jobs[1].created)
         for job in Job.get_all():
@@ -108,6 +117,14 @@ class ServerTest(TestCase):
         self.assertFalse(Server.get_by_id(2).test_become()['status'])
         self.assertEqual(Server.get_by_id(3), None)
 
+    def test_ciphers(self):
+        server = Server.get_by_id(1)
+        server.ciphers = 'aes256-ctr, aes128-ctr'
+        server.full_clean()
+        server.ciphers = 'aes256-ctr,unknown-cbc'
+        with self.assertRaisesMessage(ValidationError, 'Unknown cipher: unknown-cbc'):
+            server.full_clean()
+
 
 class ProbeTest(TestCase):
     fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
@@ -130,8 +147,11 @@ class ProbeTest(TestCase):
         self.assertFalse(probe.stop()['status'])
         self.assertFalse(probe.reload()['status'])
         self.assertEqual('Failed to get status', probe.status())
+        self.assertIsNotNone(probe.health().error)
+        self.assertFalse(probe.health().running)
         probe.installed = False
         self.assertEqual('Not installed', probe.uptime())
+        self.assertEqual(str(probe.health()), 'not installed')
         probe = Probe.get_by_id(99)
         self.assertEqual(probe, None)
         with self.assertRaises(AttributeError):
@@ -148,6 +168,48 @@ class ProbeTest(TestCase):
             Probe.objects.create(name="suricata1")
 
 
+class ProbeStatusTest(TestCase):
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
+
+    @classmethod
+    def setUpTestData(cls):
+        pass
+
+    def test_probe_status(self):
+        probe = Probe.get_by_id(1)
+        self.assertIsNone(probe.last_status())
+        self.assertEqual(status(probe.id), 'secondary')
+        ProbeStatus.store(probe, ProbeHealth(state='active', sub_state='running', uptime=100, pid=42))
+        probe = Probe.get_by_id(1)
+        self.assertFalse(probe.last_status().stale)
+        self.assertEqual(probe.last_status().health.pid, 42)
+        self.assertEqual(status(probe.id), 'success')
+        ProbeStatus.objects.filter(probe=probe).update(updated=timezone.now() - timedelta(days=1))
+        probe = Probe.get_by_id(1)
+        self.assertTrue(probe.last_status().stale)
+        self.assertGreaterEqual(probe.last_status().health.uptime, 100 + 86400)
+        probe.refresh_health()
+        self.assertIsNotNone(Probe.get_by_id(1).last_status().health.error)
+        self.assertEqual(status(probe.id), 'danger')
+        probe.start()
+        self.assertIsNone(Probe.get_by_id(1).last_status())
+
+    def test_probe_health_sample(self):
+        probe = Probe.get_by_id(1)
+        probe.refresh_health()
+        sample = ProbeHealthSample.objects.get(probe=probe)
+        self.assertEqual(sample.state, 'unreachable')
+        self.assertIsNone(sample.latency)
+        self.assertEqual(ProbeHealthSample.from_health(probe, ProbeHealth(state='active', sub_state='running',
+                                                                          uptime=10, latency=12.5)).state, 'running')
+        self.assertEqual(ProbeHealthSample.from_health(probe, ProbeHealth(state='failed')).state, 'failed')
+        self.assertEqual(ProbeHealthSample.from_health(probe, ProbeHealth(state='inactive')).state, 'stopped')
+        ProbeHealthSample.objects.bulk_create([ProbeHealthSample(probe=probe, state='running',
+                                                                 timestamp=timezone.now() - timedelta(days=365))])
+        self.assertEqual(ProbeHealthSample.purge(), 1)
+        self.assertEqual(ProbeHealthSample.objects.count(), 1)
+
+
 class ProbeConfigurationTest(TestCase):
     fixtures = ['init', 'test-core-probeconfiguration']
 
@@ -186,3 +248,34 @@ class ConfigurationTest(TestCase):
         conf.value = "test"
         conf.save()
         self.assertEqual(conf.get_value("PUSHBULLET_API_KEY"), "test")
+        self.assertEqual(Configuration.get_values("PUSHBULLET_API_KEY", "SPLUNK_HOST", "inexist"),
+                         {"PUSHBULLET_API_KEY": "test", "SPLUNK_HOST": None, "inexist": None})
+        self.assertEqual(len(Configuration.get_values()), Configuration.objects.count())
+
+
+class ConfigurationCacheTest(TransactionTestCase):
+    fixtures = ['init']
+
+    def setUp(self):
+        Configuration.invalidate()
+
+    def tearDown(self):
+        Configuration.invalidate()
+
+    def test_cache(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(Configuration.get_value("SPLUNK_HOST"))
+            self.assertIsNone(Configuration.get_value("SPLUNK_USER"))
+            Configuration.get_values("SPLUNK_HOST", "SPLUNK_USER", "SPLUNK_PASSWORD")
+        conf = Configuration.objects.get(key="SPLUNK_HOST")
+        conf.value = "splunk.test"
+        conf.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(Configuration.get_value("SPLUNK_HOST"), "splunk.test")
+            self.assertEqual(Configuration.get_value("SPLUNK_HOST"), "splunk.test")
+        conf.delete()
+        self.assertIsNone(Configuration.get_value("SPLUNK_HOST"))
+        with override_settings(CONFIGURATION_CACHE_TTL=0):
+            with self.assertNumQueries(2):
+                Configuration.get_value("SPLUNK_USER")
+                Configuration.get_value("SPLUNK_USER")
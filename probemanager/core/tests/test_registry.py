@@ -0,0 +1,38 @@
+""" venv/bin/python probemanager/manage.py test core.tests.test_registry --settings=probemanager.settings.dev """
+from django.apps import apps
+from django.test import TestCase
+
+from core.models import Probe
+from core.registry import registry
+
+
+class RegistryTest(TestCase):
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
+
+    @classmethod
+    def setUpTestData(cls):
+        pass
+
+    def test_get_class(self):
+        self.assertIs(registry.get_class(''), Probe)
+        self.assertIsNone(registry.get_class('Unknown'))
+        for (app_label, class_name), model in registry.classes.items():
+            self.assertTrue(issubclass(model, Probe))
+            self.assertEqual(model._meta.app_label, app_label)
+            self.assertIn(model, apps.get_models())
+
+    def test_get_probe(self):
+        with self.assertNumQueries(1):
+            probe = registry.get_by_id(1)
+            self.assertEqual(probe.server.os.name, 'debian')
+            self.assertIsNotNone(probe.server.ssh_private_key_file)
+        self.assertEqual(probe, Probe.get_by_id(1))
+        self.assertEqual(registry.get_by_name('probe1'), probe)
+        with self.assertLogs('core.registry', level='DEBUG'):
+            self.assertIsNone(registry.get_by_id(99))
+        self.assertIsNone(registry.get_by_name('probe99'))
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.filter(installed=True), [probe])
+        Probe.objects.filter(id=1).update(type='Unknown')
+        with self.assertLogs('core.registry', level='ERROR'):
+            self.assertIsNone(registry.get_by_id(1))
@@ -1,9 +1,20 @@
 """ venv/bin/python probemanager/manage.py test core.tests.test_ssh --settings=probemanager.settings.dev """
+import errno
+import os
+import socket
+from datetime import timedelta
+
+import paramiko
+
 from django.conf import settings
 from django.test import TestCase
+from django.utils import timezone
 
-from core.models import Server
-from core.ssh import connection, execute, execute_copy
+from core.exceptions import CircuitOpenError, ServerBusyError
+from core.models import Server, Job, TransferStatistic, SshSession, SshCircuit
+from core.ssh import connection, distribute, execute, execute_copy, execute_fleet, execute_stream, fan_out, \
+    guard, is_transient, pool, private_keys
+from core.utils import get_tmp_dir, sha256_file
 
 
 class SshCoreTest(TestCase):
@@ -58,3 +69,199 @@ class SshCoreTest(TestCase):
         server = Server.get_by_id(1)
         result = execute_copy(server, src=settings.ROOT_DIR + '/LICENSE', dest='/tmp/LICENSE', become=True)
         self.assertEqual(result, {'copy': 'OK', 'mv': {'mv': 'OK'}})
+
+    def test_pool(self):
+        server = Server.get_by_id(1)
+        pool.discard(server)
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        transport = pool.acquire(server)
+        pool.release(transport)
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        same_transport = pool.acquire(server)
+        pool.release(same_transport)
+        self.assertIs(transport, same_transport)
+        # Dead transport -> reconnect
+        transport.client.get_transport().close()
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        new_transport = pool.acquire(server)
+        pool.release(new_transport)
+        self.assertIsNot(transport, new_transport)
+        self.assertTrue(new_transport.is_alive())
+        # Server modified -> connections closed
+        server.save()
+        self.assertFalse(new_transport.is_alive())
+
+    def test_execute_batch(self):
+        server = Server.get_by_id(1)
+        self.assertEqual(execute(server, {'test_hostame': "hostname", 'test_ok': "hostname 1>/dev/null",
+                                          'test_lines': "echo 'a'; echo 'b'"}, batch=True),
+                         {'test_hostame': 'test-travis', 'test_ok': 'OK', 'test_lines': 'ab'})
+        self.assertEqual(execute(server, {'test_hostame': "hostname", 'test_whoami': "whoami"}, become=True,
+                                 batch=True),
+                         {'test_hostame': 'test-travis', 'test_whoami': 'root'})
+        with self.assertRaisesRegex(Exception, 'test_fail'):
+            execute(server, {'test_hostame': "hostname", 'test_fail': "service ssh status"}, batch=True)
+        # More on stderr than the window of the channel, read with stdout.
+        self.assertEqual(execute(server, {'test_stderr': "head -c 4000000 /dev/zero | tr '\\0' e >&2; echo ok"},
+                                 batch=True), {'test_stderr': 'ok'})
+
+    def test_execute_fleet(self):
+        server = Server.objects.select_related('ssh_private_key_file').get(id=1)
+        results = list(execute_fleet([server, server], {'test_hostame': "hostname"}))
+        self.assertEqual(len(results), 2)
+        for srv, response in results:
+            self.assertEqual(srv, server)
+            self.assertEqual(response, {'status': True, 'result': {'test_hostame': 'test-travis'}})
+        results = list(execute_fleet([server], {'test_fail': "service ssh status"}))
+        self.assertFalse(results[0][1]['status'])
+        results = list(execute_fleet([server], {'test_sleep': "sleep 5"}, timeout=1))
+        self.assertEqual(results[0][1], {'status': False, 'errors': 'Timeout after 1s'})
+        self.assertEqual(list(fan_out([], lambda srv: srv)), [])
+
+    def test_private_keys(self):
+        server = Server.get_by_id(1)
+        ssh_key = server.ssh_private_key_file
+        private_keys.invalidate(ssh_key)
+        pkey = private_keys.get(ssh_key)
+        self.assertIs(private_keys.get(ssh_key), pkey)
+        private_keys.invalidate(ssh_key)
+        self.assertIsNot(private_keys.get(ssh_key), pkey)
+        self.assertEqual(private_keys.get(ssh_key), pkey)
+
+    def test_private_key_types(self):
+        with get_tmp_dir('keys') as tmp_dir:
+            paramiko.ECDSAKey.generate().write_private_key_file(tmp_dir + 'ecdsa', password=settings.SECRET_KEY)
+            paramiko.RSAKey.generate(2048).write_private_key_file(tmp_dir + 'rsa', password=settings.SECRET_KEY)
+            self.assertIsInstance(private_keys.load(tmp_dir + 'ecdsa'), paramiko.ECDSAKey)
+            self.assertIsInstance(private_keys.load(tmp_dir + 'rsa'), paramiko.RSAKey)
+
+    def test_execute_stream(self):
+        server = Server.get_by_id(1)
+        chunks = list(execute_stream(server, 'test_lines', "echo 'a'; echo 'b' >&2; echo 'c'"))
+        self.assertEqual(''.join(text for source, text in chunks if source == 'stdout'), 'a\nc\n')
+        self.assertEqual(''.join(text for source, text in chunks if source == 'stderr'), 'b\n')
+        with self.assertRaisesRegex(Exception, 'Exitcode: 3'):
+            list(execute_stream(server, 'test_fail', "echo 'a'; exit 3"))
+        job = Job.create_job('test_stream', 'probe1')
+        self.assertEqual(job.execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        job.refresh_from_db()
+        self.assertEqual(job.result, '$ test_hostame\ntest-travis\n')
+
+    def test_execute_copy_skip_identical(self):
+        server = Server.get_by_id(1)
+        execute(server, {'rm': "rm -f /tmp/LICENSE"}, become=True)
+        result = execute_copy(server, src=settings.ROOT_DIR + '/LICENSE', dest='/tmp/LICENSE', become=True,
+                              skip_identical=True)
+        self.assertEqual(result, {'copy': 'OK', 'mv': {'mv': 'OK'}})
+        result = execute_copy(server, src=settings.ROOT_DIR + '/LICENSE', dest='/tmp/LICENSE', become=True,
+                              skip_identical=True)
+        self.assertEqual(result, {'copy': 'Unchanged'})
+        result = execute_copy(server, src=settings.ROOT_DIR + '/README.rst', dest='/tmp/LICENSE', become=True,
+                              skip_identical=True)
+        self.assertEqual(result, {'copy': 'OK', 'mv': {'mv': 'OK'}})
+
+    def test_execute_copy_delta(self):
+        server = Server.get_by_id(1)
+        with open(settings.ROOT_DIR + '/LICENSE', 'rb') as f:
+            content = f.read()
+        with get_tmp_dir('test_ssh') as tmp_dir:
+            with open(tmp_dir + 'big', 'wb') as f:
+                f.write(content * 20)
+            result = execute_copy(server, src=tmp_dir + 'big', dest='/tmp/big', become=True, delta=True)
+            self.assertEqual(result, {'copy': 'OK', 'mv': {'mv': 'OK'}})
+            with open(tmp_dir + 'big', 'wb') as f:
+                f.write(b'changed' + content * 21)
+            result = execute_copy(server, src=tmp_dir + 'big', dest='/tmp/big', become=True, delta=True)
+            self.assertEqual(result['copy'], 'OK')
+            self.assertLess(result['delta']['sent'], len(content) * 2)
+            self.assertEqual(execute(server, {'sha256': "sha256sum /tmp/big"})['sha256'].split(' ')[0],
+                             sha256_file(tmp_dir + 'big'))
+
+    def test_transport_options(self):
+        server = Server.get_by_id(1)
+        server.compression = True
+        server.ciphers = 'aes256-ctr'
+        server.save()
+        client = connection(server)
+        self.assertEqual(client.get_transport().local_cipher, 'aes256-ctr')
+        client.close()
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        self.assertEqual(execute_copy(server, src=settings.ROOT_DIR + '/LICENSE', dest='LICENSE'), {'copy': 'OK'})
+        transfer = TransferStatistic.objects.first()
+        self.assertEqual(transfer.method, 'Full')
+        self.assertTrue(transfer.compression)
+        self.assertEqual(transfer.cipher, 'aes256-ctr')
+        self.assertEqual(transfer.size, os.path.getsize(settings.ROOT_DIR + '/LICENSE'))
+        self.assertEqual(transfer.sent, transfer.size)
+
+    def test_distribute(self):
+        server = Server.objects.select_related('ssh_private_key_file').get(id=1)
+        execute(server, {'rm': "rm -f LICENSE"})
+        results = list(distribute([server], src=settings.ROOT_DIR + '/LICENSE', dest='LICENSE'))
+        self.assertEqual(results[0][0], server)
+        self.assertTrue(results[0][1]['status'])
+        self.assertEqual(results[0][1]['result']['copy'], {'copy': 'OK'})
+        self.assertGreater(results[0][1]['result']['throughput'], 0)
+        results = list(distribute([server], src=settings.ROOT_DIR + '/LICENSE', dest='LICENSE'))
+        self.assertEqual(results[0][1]['result']['copy'], {'copy': 'Unchanged'})
+        results = list(distribute([server], src=settings.ROOT_DIR + '/LICENSE', dest='/'))
+        self.assertFalse(results[0][1]['status'])
+
+    def test_guard(self):
+        server = Server.get_by_id(1)
+        pool.discard(server)
+        for i in range(guard.max_sessions):
+            SshSession.objects.create(server=server, owner='test')
+        wait_timeout = guard.wait_timeout
+        guard.wait_timeout = 1
+        with self.assertRaises(ServerBusyError):
+            execute(server, {'test_hostame': "hostname"})
+        guard.wait_timeout = wait_timeout
+        SshSession.objects.filter(server=server).update(renewed=timezone.now() - timedelta(days=1))
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        # One slot for the pooled connection, the commands on it do not query the database.
+        self.assertEqual(SshSession.objects.filter(server=server).count(), 1)
+        with self.assertNumQueries(0):
+            execute(server, {'test_hostame': "hostname"})
+        # Expired meanwhile : a new slot.
+        SshSession.objects.filter(server=server).delete()
+        pooled = pool.acquire(server)
+        pooled.slot_renewed -= guard.lease
+        pool.release(pooled)
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        self.assertEqual(SshSession.objects.filter(server=server).count(), 1)
+        pool.discard(server)
+        self.assertEqual(SshSession.objects.filter(server=server).count(), 0)
+
+    def test_circuit_breaker(self):
+        server = Server.get_by_id(1)
+        server.remote_port = 1
+        server.save()
+        for i in range(guard.failures):
+            with self.assertRaises(Exception) as cm:
+                execute(server, {'test_hostame': "hostname"})
+            self.assertNotIsInstance(cm.exception, CircuitOpenError)
+        with self.assertRaises(CircuitOpenError):
+            execute(server, {'test_hostame': "hostname"})
+        server.remote_port = 22
+        server.save()
+        SshCircuit.objects.filter(server=server).update(opened_until=timezone.now())
+        self.assertEqual(execute(server, {'test_hostame': "hostname"}), {'test_hostame': 'test-travis'})
+        self.assertEqual(SshCircuit.objects.get(server=server).failures, 0)
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(socket.timeout()))
+        self.assertTrue(is_transient(ConnectionResetError(errno.ECONNRESET, 'Connection reset by peer')))
+        self.assertTrue(is_transient(OSError(errno.EHOSTUNREACH, 'No route to host')))
+        self.assertTrue(is_transient(ServerBusyError('Server busy')))
+        self.assertTrue(is_transient(paramiko.ssh_exception.NoValidConnectionsError(
+            {('127.0.0.1', 1): ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused')})))
+        self.assertFalse(is_transient(paramiko.AuthenticationException('Authentication failed.')))
+        self.assertFalse(is_transient(CircuitOpenError('Server unreachable')))
+        self.assertFalse(is_transient(Exception("Command Failed", "service ssh status", 3)))
+        self.assertFalse(is_transient(socket.gaierror(socket.EAI_NONAME, 'Name or service not known')))
+        server = Server.get_by_id(1)
+        server.remote_port = 1
+        with self.assertRaises(Exception) as cm:
+            connection(server)
+        self.assertTrue(is_transient(cm.exception))
@@ -0,0 +1,220 @@
+""" venv/bin/python probemanager/manage.py test core.tests.test_ssh_standin --settings=probemanager.settings.dev """
+import json
+import os
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.db import connection as db_connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.models import Job, Probe, ProbeHealthSample, ProbeStatus, SshCircuit
+from core.ssh import connection, distribute, execute, execute_fleet, open_sftp, pool
+from core.tasks import check_probe, deploy_rules, fleet_chunk, refresh_probes_status, run_on_fleet, update_probe
+from core.tests.sshserver import StandInServersMixin
+from rules.models import Rule
+
+
+class SshStandInTest(StandInServersMixin, TestCase):
+    """
+    The SSH layer against local stand-in servers, without a real remote host.
+    """
+    fixtures = ['init']
+
+    def test_connection(self):
+        connection(self.servers[0]).close()
+        self.assertEqual(self.stand_ins[0].connections, 1)
+
+    def test_pool(self):
+        for i in range(5):
+            self.assertEqual(execute(self.servers[0], {'hostname': "hostname"}), {'hostname': 'stand-in-0'})
+        self.assertEqual(self.stand_ins[0].connections, 1)
+        self.assertEqual(self.stand_ins[0].commands, 5)
+
+    def test_circuit_failures(self):
+        self.stand_ins[0].refuse = True
+        with self.assertRaises(Exception):
+            execute(self.servers[0], {'hostname': "hostname"})
+        self.assertEqual(SshCircuit.objects.get(server=self.servers[0]).failures, 1)
+        # The errors on this side are not failures of the server.
+        key_path = settings.MEDIA_ROOT + "/" + self.key_file
+        os.rename(key_path, key_path + '.moved')
+        try:
+            with self.assertRaises(FileNotFoundError):
+                execute(self.servers[1], {'hostname': "hostname"})
+        finally:
+            os.rename(key_path + '.moved', key_path)
+        with self.assertRaises(IOError):
+            with pool.client(self.servers[1]) as client:
+                open_sftp(client).stat('/missing')
+        self.assertFalse(SshCircuit.objects.filter(server=self.servers[1]).exists())
+
+    def test_fleet_check_samples(self):
+        names = list()
+        for server in self.servers:
+            names.append(Probe.objects.create(name='probe-' + server.name, server=server, installed=True).name)
+        job = Job.create_fleet_job('check_probe_fleet', 'type=* server=* tag=*', names)
+        with CaptureQueriesContext(db_connection) as queries:
+            fleet_chunk(job.id, 'check_probe', names)
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT INTO "core_probehealthsample"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(ProbeHealthSample.objects.count(), self.hosts)
+        self.assertEqual(Job.objects.get(id=job.id).status, 'Error')
+
+    def test_deploy_rules_unchanged(self):
+        Probe.objects.create(name='stand-in-probe', server=self.servers[0], installed=True)
+        execute(self.servers[0], {'start': "service probe start"}, become=True)
+        started = self.stand_ins[0].services['probe']
+        with mock.patch.object(Probe, 'deploy_rules', lambda probe: {'status': True, 'unchanged': True}, create=True):
+            self.assertEqual(deploy_rules('stand-in-probe'), {"message": "Probe stand-in-probe rules unchanged"})
+        # Not reloaded.
+        self.assertEqual(self.stand_ins[0].services['probe'], started)
+        self.assertEqual(Job.objects.get(name='deploy_rules').result, 'Rules unchanged, nothing deployed')
+        with mock.patch.object(Probe, 'deploy_rules', lambda probe: {'status': True}, create=True):
+            self.assertEqual(deploy_rules('stand-in-probe'),
+                             {"message": "Probe stand-in-probe deployed rules successfully"})
+        self.assertGreater(self.stand_ins[0].services['probe'], started)
+
+    def test_deploy_rules_hash(self):
+        probe = Probe.objects.create(name='stand-in-probe', server=self.servers[0], installed=True)
+        # Without rulesets.
+        self.assertIsNone(probe.get_rules_hash())
+        rule = Rule.objects.create(rev=1, rule_full='alert ip any any -> any any (msg:"stand-in"; sid:1; rev:1;)')
+        deployed = list()
+
+        def deploy(probe):
+            deployed.append(probe.name)
+            return {'status': True}
+
+        with mock.patch.object(Probe, 'get_rules', lambda probe: [Rule.objects.all()]), \
+                mock.patch.object(Probe, 'deploy_rules', deploy, create=True):
+            self.assertEqual(deploy_rules('stand-in-probe'),
+                             {"message": "Probe stand-in-probe deployed rules successfully"})
+            self.assertEqual(deploy_rules('stand-in-probe'), {"message": "Probe stand-in-probe rules unchanged"})
+            self.assertEqual(len(deployed), 1)
+            rule.rev = 2
+            rule.save()
+            self.assertEqual(deploy_rules('stand-in-probe'),
+                             {"message": "Probe stand-in-probe deployed rules successfully"})
+        self.assertEqual(len(deployed), 2)
+
+    def test_update_probe(self):
+        Probe.objects.create(name='stand-in-probe', server=self.servers[0], installed=True)
+
+        def update(probe, version=None):
+            response = probe.run_commands({'download': "echo downloaded", 'upgrade': "echo upgraded"})
+            # Streamed in the result of the job while the task runs.
+            running = Job.objects.get(id=probe.job.id)
+            self.assertEqual(running.status, 'In progress')
+            self.assertIn('$ download\ndownloaded\n$ upgrade\n', running.result)
+            return {'status': response == {'download': 'downloaded', 'upgrade': 'upgraded'}}
+
+        with mock.patch.object(Probe, 'update', update, create=True):
+            self.assertEqual(update_probe('stand-in-probe'), {"message": "Probe stand-in-probe updated successfully"})
+        job = Job.objects.get(name='update_probe')
+        self.assertEqual(job.status, 'Completed')
+        self.assertEqual(job.result, '$ download\ndownloaded\n$ upgrade\nupgraded\n\n'
+                                     'Probe stand-in-probe updated successfully')
+
+    def test_check_probe(self):
+        Probe.objects.create(name='stand-in-probe', server=self.servers[0], installed=True)
+        execute(self.servers[0], {'start': "service probe start"}, become=True)
+        for i in range(3):
+            self.assertEqual(check_probe('stand-in-probe'), {"message": "OK probe stand-in-probe is running"})
+        # Only the first check writes a job, the others update the cached status.
+        self.assertEqual(Job.objects.filter(name='check_probe').count(), 1)
+        execute(self.servers[0], {'stop': "service probe stop"}, become=True)
+        self.assertEqual(check_probe('stand-in-probe'), {"message": "KO probe stand-in-probe is not running"})
+        self.assertEqual(check_probe('stand-in-probe'), {"message": "KO probe stand-in-probe is not running"})
+        self.assertEqual(Job.objects.filter(name='check_probe').count(), 2)
+
+
+class SshStandInFanOutTest(StandInServersMixin, TransactionTestCase):
+    """
+    The fan-out on local stand-in servers : its threads see only the committed rows.
+    """
+    fixtures = ['init']
+
+    def test_rollout(self):
+        deployed = list()
+
+        def deploy(probe):
+            deployed.append(probe.name)
+            return {'status': True}
+
+        for server in self.servers:
+            Probe.objects.create(name='probe-' + server.name, server=server, installed=True, tags='stand-in')
+            execute(server, {'start': "service probe start"}, become=True)
+        with mock.patch.object(Probe, 'deploy_rules', deploy, create=True):
+            response = run_on_fleet('deploy_rules', tag='stand-in', rollout=True)
+        self.assertEqual(response['message'], 'Rules deployed on 3 probes in 2 waves')
+        self.assertEqual(sorted(deployed), ['probe-stand-in-0', 'probe-stand-in-1', 'probe-stand-in-2'])
+        job = Job.objects.get(id=response['job'])
+        self.assertEqual(job.status, 'Completed')
+        self.assertEqual(json.loads(job.result)['failed'], 0)
+        self.assertEqual(Job.objects.filter(name='deploy_rules', status='Completed').count(), 3)
+
+    def test_fleet_fan_out(self):
+        self.stand_ins[-1].failure_rate = 1
+        results = dict(execute_fleet(self.servers, {'start': "service suricata start"}, become=True))
+        self.assertEqual(len(results), self.hosts)
+        self.assertFalse(results[self.servers[-1]]['status'])
+        for server in self.servers[:-1]:
+            self.assertTrue(results[server]['status'])
+        results = dict(execute_fleet(self.servers[:-1], {'status': "service suricata status"}, become=True))
+        for response in results.values():
+            self.assertIn('Active: active (running)', response['result']['status'])
+
+    def test_fleet_timeout(self):
+        self.stand_ins[-1].latency = 2
+        results = dict(execute_fleet(self.servers, {'hostname': "hostname"}, concurrency=1, timeout=1))
+        self.assertEqual(results[self.servers[-1]], {'status': False, 'errors': "Timeout after 1s"})
+        for server in self.servers[:-1]:
+            self.assertTrue(results[server]['status'])
+        # fan_out waits for the thread of the server after its timeout, the command is finished.
+        self.assertEqual(self.stand_ins[-1].commands, 1)
+        self.assertEqual(execute(self.servers[-1], {'hostname': "hostname"}), {'hostname': 'stand-in-2'})
+        self.assertEqual(self.stand_ins[-1].connections, 1)
+
+    def test_distribute(self):
+        results = list(distribute(self.servers, src=settings.ROOT_DIR + '/LICENSE', dest='/etc/suricata/LICENSE',
+                                  become=True))
+        self.assertEqual(len(results), self.hosts)
+        for server, response in results:
+            self.assertTrue(response['status'])
+            self.assertEqual(response['result']['copy'], {'copy': 'OK', 'mv': {'mv': 'OK'}})
+        for server, response in distribute(self.servers, src=settings.ROOT_DIR + '/LICENSE',
+                                           dest='/etc/suricata/LICENSE', become=True):
+            self.assertEqual(response['result']['copy'], {'copy': 'Unchanged'})
+
+    def test_probe_health(self):
+        probe = Probe.objects.create(name='stand-in-probe', server=self.servers[0], installed=True)
+        self.assertEqual(str(probe.health()), 'inactive (dead)')
+        execute(self.servers[0], {'start': "service probe start"}, become=True)
+        commands = self.stand_ins[0].commands
+        health = probe.health()
+        self.assertEqual(self.stand_ins[0].commands, commands + 1)
+        self.assertTrue(health.running)
+        self.assertIsNotNone(health.pid)
+        self.assertGreaterEqual(health.uptime, 0)
+        self.assertEqual(refresh_probes_status(), {"message": "1 probes refreshed"})
+        self.assertTrue(Probe.get_by_id(probe.id).last_status().health.running)
+        sample = ProbeHealthSample.objects.get(probe=probe)
+        self.assertEqual(sample.state, 'running')
+        self.assertGreater(sample.latency, 0)
+        self.assertEqual(refresh_probes_status(), {"message": "0 probes refreshed"})
+
+    def test_check_probe_after_refresh(self):
+        probe = Probe.objects.create(name='stand-in-probe', server=self.servers[0], installed=True)
+        execute(self.servers[0], {'start': "service probe start"}, become=True)
+        self.assertEqual(check_probe('stand-in-probe'), {"message": "OK probe stand-in-probe is running"})
+        execute(self.servers[0], {'stop': "service probe stop"}, become=True)
+        ProbeStatus.objects.filter(probe=probe).update(updated=timezone.now() - timedelta(hours=1))
+        # The periodic refresh sees the stop first, the next check still writes the transition.
+        self.assertEqual(refresh_probes_status(), {"message": "1 probes refreshed"})
+        self.assertFalse(Probe.get_by_id(probe.id).last_status().health.running)
+        self.assertEqual(check_probe('stand-in-probe'), {"message": "KO probe stand-in-probe is not running"})
+        self.assertEqual(Job.objects.filter(name='check_probe').count(), 2)
@@ -0,0 +1,150 @@
+""" venv/bin/python probemanager/manage.py test core.tests.test_tasks --settings=probemanager.settings.dev """
+import json
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.models import Job, Probe, ProbeLock
+from core.tasks import check_probe, deploy_rules, fleet_chunk, reload_probe, retry_countdown, run_on_fleet, \
+    select_probes, split_waves
+
+
+def serial_fan_out(servers, function, concurrency=None, timeout=None):
+    for server in servers:
+        try:
+            yield server, {'status': True, 'result': function(server)}
+        except Exception as e:
+            yield server, {'status': False, 'errors': str(e)}
+
+
+class FleetTest(TestCase):
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
+
+    @classmethod
+    def setUpTestData(cls):
+        Probe.objects.filter(name='probe1').update(tags='dmz, paris')
+
+    def test_select_probes(self):
+        self.assertEqual(select_probes(), ['probe1'])
+        self.assertEqual(select_probes(tag='paris'), ['probe1'])
+        self.assertEqual(select_probes(tag='DMZ'), ['probe1'])
+        self.assertEqual(select_probes(tag='par'), [])
+        self.assertEqual(select_probes(probe_type='suricata'), [])
+        self.assertEqual(select_probes(server='unknown'), [])
+
+    def test_fleet_job(self):
+        job = Job.create_fleet_job('check_probe_fleet', 'type=* server=* tag=dmz', ['probe1'])
+        self.assertEqual(job.status, 'In progress')
+        fleet_chunk(job.id, 'check_probe', ['probe1'])
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.status, 'Error')
+        self.assertIsNotNone(job.completed)
+        result = json.loads(job.result)
+        self.assertEqual(result['total'], 1)
+        self.assertEqual(result['failed'], 1)
+        self.assertIn('exception', result['probes']['probe1'])
+
+    def test_run_on_fleet(self):
+        response = run_on_fleet('check_probe', tag='lyon')
+        self.assertEqual(response['message'], '0 probes selected for check_probe')
+        job = Job.objects.get(id=response['job'])
+        self.assertEqual(job.status, 'Completed')
+        self.assertEqual(job.probe, 'type=* server=* tag=lyon')
+        self.assertEqual(run_on_fleet('unknown'), {"message": "Error - unknown action : unknown"})
+
+    def test_split_waves(self):
+        names = ['probe' + str(i) for i in range(1, 8)]
+        self.assertEqual(split_waves(names, set(), 1, 3), [['probe1'], ['probe2', 'probe3', 'probe4'],
+                                                           ['probe5', 'probe6', 'probe7']])
+        self.assertEqual(split_waves(names, {'probe4', 'probe6'}, 2, 5), [['probe4', 'probe6'],
+                                                                          ['probe1', 'probe2', 'probe3', 'probe5',
+                                                                           'probe7']])
+        self.assertEqual(split_waves(names[:2], set(), 0, 10), [['probe1', 'probe2']])
+        self.assertEqual(split_waves([], set(), 1, 10), [])
+
+    def test_rollout(self):
+        # The server of probe1 is not reachable : the canary fails and the rollout stops.
+        # The fan-out runs in this thread, its threads would not see the probes of the test transaction.
+        with mock.patch('core.tasks.fan_out', serial_fan_out):
+            response = run_on_fleet('deploy_rules', tag='dmz', rollout=True)
+        self.assertEqual(response['message'], 'Rollout stopped after the wave 1/1 : 1/1 probes failed')
+        job = Job.objects.get(id=response['job'])
+        self.assertEqual(job.name, 'deploy_rules_rollout')
+        self.assertEqual(job.status, 'Error')
+        result = json.loads(job.result)
+        self.assertEqual(result['failed'], 1)
+        self.assertEqual(result['skipped'], [])
+        self.assertEqual(result['stopped'], response['message'])
+        self.assertEqual(result['probes']['probe1']['message'], 'Error for probe probe1 to deploy rules')
+        self.assertEqual(Job.objects.get(name='deploy_rules', probe='probe1').status, 'Error')
+
+    def test_rollout_without_model(self):
+        Probe.objects.create(name='probe-unknown', type='Unknown', server=Probe.get_by_name('probe1').server,
+                             tags='lyon')
+        response = run_on_fleet('deploy_rules', tag='lyon', rollout=True)
+        self.assertEqual(response['message'], 'Rollout stopped after the wave 1/1 : 1/1 probes failed')
+        job = Job.objects.get(id=response['job'])
+        self.assertEqual(job.status, 'Error')
+        self.assertIsNotNone(job.completed)
+        result = json.loads(job.result)
+        self.assertEqual(result['probes']['probe-unknown'], {"message": "Error - probe is None : probe-unknown"})
+
+
+class ProbeLockTest(TestCase):
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
+
+    @classmethod
+    def setUpTestData(cls):
+        pass
+
+    def test_duplicate(self):
+        job = Job.create_job('reload_probe', 'probe1')
+        ProbeLock.objects.create(probe='probe1', task='reload_probe')
+        self.assertEqual(reload_probe('probe1'), {"message": "Probe probe1 reload_probe already in progress",
+                                                  "job": job.id})
+        self.assertEqual(Job.objects.filter(name='reload_probe').count(), 1)
+
+    @override_settings(PROBE_LOCK_WAIT=0)
+    def test_busy(self):
+        ProbeLock.objects.create(probe='probe1', task='install_probe')
+        response = deploy_rules('probe1')
+        self.assertEqual(response['exception'], 'Probe probe1 busy with the task install_probe')
+        self.assertEqual(Job.objects.get(name='deploy_rules').status, 'Error')
+        self.assertEqual(ProbeLock.objects.get(probe='probe1').task, 'install_probe')
+
+    def test_release(self):
+        ProbeLock.objects.create(probe='probe1', task='reload_probe', created=timezone.now() - timedelta(days=1))
+        reload_probe('probe1')
+        self.assertEqual(Job.objects.filter(name='reload_probe').count(), 1)
+        self.assertFalse(ProbeLock.objects.filter(probe='probe1').exists())
+        lock, job = ProbeLock.acquire('reload_probe', 'probe1')
+        self.assertIsNone(job)
+        self.assertEqual(ProbeLock.acquire('reload_probe', 'probe1'), (None, None))
+        lock.release()
+        self.assertFalse(ProbeLock.objects.exists())
+
+
+class RetryTest(TestCase):
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-core-probe']
+
+    @classmethod
+    def setUpTestData(cls):
+        pass
+
+    @override_settings(TASK_RETRY_BACKOFF=10, TASK_RETRY_BACKOFF_MAX=60)
+    def test_retry_countdown(self):
+        for retries, backoff in ((0, 10), (1, 20), (2, 40), (3, 60), (10, 60)):
+            for i in range(20):
+                countdown = retry_countdown(retries)
+                self.assertGreaterEqual(countdown, backoff / 2)
+                self.assertLessEqual(countdown, backoff)
+
+    def test_direct_call(self):
+        # Called directly (by a fleet task), the task fails at once.
+        response = check_probe('probe1')
+        self.assertIn('exception', response)
+        job = Job.objects.get(name='check_probe')
+        self.assertEqual(job.status, 'Error')
+        self.assertEqual(job.attempts, 1)
@@ -1,4 +1,5 @@
 """ venv/bin/python probemanager/manage.py test core.tests.test_utils --settings=probemanager.settings.dev """
+import json
 import os
 from django.test import TestCase
 from django.conf import settings
@@ -6,8 +7,9 @@ from django_celery_beat.models import CrontabSchedule, PeriodicTask
 
 from core.models import Probe, Server
 from core.utils import create_deploy_rules_task, create_reload_task, encrypt, decrypt, add_10_min, \
-    add_1_hour, create_check_task, get_tmp_dir, process_cmd, find_procs_by_name
-from rules.models import Source
+    add_1_hour, create_check_task, get_tmp_dir, process_cmd, find_procs_by_name, sha256_file, create_fleet_task, \
+    hash_rules
+from rules.models import Rule, Source
 
 
 class UtilsCoreTest(TestCase):
@@ -40,6 +42,34 @@ class UtilsCoreTest(TestCase):
         self.assertEqual(periodic_task.args, str([Probe.get_by_id(2).name, ]).replace("'", '"'))
         self.assertEqual(periodic_task.crontab, CrontabSchedule.objects.get(id=2))
 
+    def test_create_fleet_task(self):
+        periodic_task = create_fleet_task('check_probe', CrontabSchedule.objects.get(id=2), tag='dmz')
+        self.assertEqual(periodic_task.task, 'core.tasks.run_on_fleet')
+        self.assertEqual(periodic_task.args, '["check_probe"]')
+        self.assertEqual(json.loads(periodic_task.kwargs), {'probe_type': None, 'server': None, 'tag': 'dmz',
+                                                            'rollout': False})
+        self.assertEqual(create_fleet_task('check_probe', CrontabSchedule.objects.get(id=2), tag='dmz'),
+                         periodic_task)
+
+    def test_hash_rules(self):
+        rule = Rule.objects.create(rev=1, rule_full='alert 1')
+        Rule.objects.create(rev=1, rule_full='alert 2')
+        rules_hash = hash_rules([Rule.objects.all()])
+        self.assertEqual(len(rules_hash), 64)
+        self.assertEqual(hash_rules([Rule.objects.all()]), rules_hash)
+        rule.rev = 2
+        rule.save()
+        self.assertNotEqual(hash_rules([Rule.objects.all()]), rules_hash)
+        rules_hash = hash_rules([Rule.objects.all()])
+        rule.enabled = False
+        rule.save()
+        self.assertNotEqual(hash_rules([Rule.objects.all()]), rules_hash)
+        self.assertNotEqual(hash_rules([]), rules_hash)
+        probe = Probe.get_by_id(1)
+        self.assertIsNone(probe.get_rules_hash())
+        probe.set_rules_hash(rules_hash)
+        self.assertEqual(Probe.get_by_id(1).rules_hash, rules_hash)
+
     def test_create_reload_task(self):
         create_reload_task(Probe.get_by_id(1))
         periodic_task = PeriodicTask.objects.get(name=Probe.get_by_id(1).name + '_reload_task')
@@ -296,3 +326,10 @@ class UtilsCoreTest(TestCase):
 
     def test_find_procs_by_name(self):
         self.assertEqual(find_procs_by_name('bash')[0].as_dict()['name'], 'bash')
+
+    def test_sha256_file(self):
+        with get_tmp_dir() as tmp:
+            with open(tmp + "test.txt", 'w') as f:
+                f.write("test")
+            self.assertEqual(sha256_file(tmp + "test.txt"),
+                             '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
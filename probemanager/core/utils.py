@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import os
@@ -6,9 +7,11 @@ import subprocess
 import time
 from contextlib import contextmanager
 
+import paramiko
 import psutil
 from cryptography.fernet import Fernet
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
 
@@ -78,6 +81,23 @@ def create_deploy_rules_task(probe, schedule=None, source=None):
                                         args=json.dumps([probe.name, ]))
 
 
+def create_fleet_task(action, schedule, probe_type=None, server=None, tag=None, rollout=False):
+    """
+    Schedules deploy_rules or check_probe on a selection of probes, in one task instead of one per probe.
+    """
+    name = "fleet_" + action + ("_rollout" if rollout else "") + "_" + str(probe_type or '*') + "_" + \
+           str(server or '*') + "_" + str(tag or '*') + "_" + str(schedule)
+    try:
+        return PeriodicTask.objects.get(name=name)
+    except PeriodicTask.DoesNotExist:
+        return PeriodicTask.objects.create(crontab=schedule,
+                                           name=name,
+                                           task='core.tasks.run_on_fleet',
+                                           args=json.dumps([action, ]),
+                                           kwargs=json.dumps({'probe_type': probe_type, 'server': server,
+                                                              'tag': tag, 'rollout': rollout}))
+
+
 def decrypt(cipher_text):
     if isinstance(cipher_text, bytes):
         return fernet_key.decrypt(cipher_text)
@@ -92,6 +112,37 @@ def encrypt(plain_text):
         return fernet_key.encrypt(plain_text.encode('utf-8')).decode('utf-8')
 
 
+def sha256_file(path, chunk_size=65536):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def validate_ciphers(value):
+    """
+    Validator of Server.ciphers : the ciphers separated by commas must be known by paramiko.
+    """
+    for cipher in value.split(','):
+        if cipher.strip() and cipher.strip() not in paramiko.Transport._preferred_ciphers:
+            raise ValidationError('Unknown cipher: ' + cipher.strip())
+
+
+def hash_rules(querysets):
+    """
+    Hash of the enabled rules of the querysets, from their id, revision and update date.
+    Changes when a rule is added, removed, enabled, disabled or updated.
+    """
+    sha256 = hashlib.sha256()
+    for queryset in querysets:
+        sha256.update(queryset.model._meta.label.encode('utf-8'))
+        rules = queryset.filter(enabled=True).order_by('pk').distinct().values_list('pk', 'rev', 'updated_date')
+        for pk, rev, updated_date in rules.iterator():
+            sha256.update((str(pk) + ':' + str(rev) + ':' + updated_date.isoformat() + '\n').encode('utf-8'))
+    return sha256.hexdigest()
+
+
 def add_10_min(crontab):
     schedule = crontab
     try:
@@ -1,4 +1,3 @@
-import importlib
 import logging
 
 from django.apps.registry import apps
@@ -8,7 +7,7 @@ from django.http import HttpResponseNotFound
 from django.shortcuts import render
 from django.utils.safestring import mark_safe
 
-from .models import Probe
+from .registry import registry
 from .tasks import deploy_rules as deploy_rules_probe, install_probe, update_probe
 from .utils import get_tmp_dir
 
@@ -22,11 +21,9 @@ def index(request):
     """
     instances = dict()
     for app in apps.get_app_configs():
-        for model in app.get_models():
-            if issubclass(model, Probe):
-                if app.verbose_name != "Core":
-                    my_class = getattr(importlib.import_module(app.label + ".models"), app.verbose_name)
-                    instances[app.label] = my_class.get_all()
+        my_class = registry.classes.get((app.label, app.verbose_name))
+        if my_class is not None:
+            instances[app.label] = my_class.get_all()
     return render(request, 'core/index.html', {'instances': instances})
 
 
@@ -35,14 +32,7 @@ def probe_index(request, pk):
     """
     Display an individual Probe instance.
     """
-    probe = Probe.get_by_id(pk)
-    if probe is None:
-        return HttpResponseNotFound('<h1>Page not found</h1>')
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound('<h1>Page not found</h1>')
     else:
@@ -54,14 +44,9 @@ def start(request, pk):
     """
     Start a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
         response_start = probe.start()
         if response_start['status']:
@@ -80,14 +65,9 @@ def stop(request, pk):
     """
     Stop a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
         response_stop = probe.stop()
         if response_stop['status']:
@@ -105,14 +85,9 @@ def restart(request, pk):
     """
     Restart a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
         response_restart = probe.restart()
         if response_restart['status']:
@@ -131,14 +106,9 @@ def reload(request, pk):
     """
     Reload a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
         response_reload = probe.reload()
         if response_reload['status']:
@@ -157,21 +127,16 @@ def status(request, pk):
     """
     Status of a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
-        response_status = probe.status()
-        if response_status:
+        health = probe.refresh_health()
+        if not health.error:
             messages.add_message(request, messages.SUCCESS,
                                  "OK probe " + str(probe.name) + " get status successfully")
         else:
-            messages.add_message(request, messages.ERROR, 'Error during the status')
+            messages.add_message(request, messages.ERROR, 'Error during the status : ' + health.error)
     except Exception as e:
         logger.exception('Error during the status : ' + str(e))
         messages.add_message(request, messages.ERROR, 'Error during the status : ' + str(e))
@@ -183,14 +148,9 @@ def install(request, pk):
     """
     Install a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
         install_probe.delay(probe.name)
     except Exception as e:
@@ -206,14 +166,9 @@ def update(request, pk):
     """
     Update a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
         update_probe.delay(probe.name)
     except Exception as e:
@@ -229,14 +184,9 @@ def deploy_conf(request, pk):
     """
     Deploy the configuration of a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     response_test = probe.configuration.test()
     logger.debug(str(response_test))
     if probe.secure_deployment:
@@ -269,16 +219,11 @@ def deploy_rules(request, pk):
     """
     Deploy the rules of a probe instance.
     """
-    probe = Probe.get_by_id(pk)
+    probe = registry.get_by_id(pk)
     if probe is None:
         return HttpResponseNotFound()
-    if probe.subtype:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.subtype)
-    else:
-        my_class = getattr(importlib.import_module(probe.type.lower() + ".models"), probe.type)
-    probe = my_class.get_by_id(pk)
     try:
-        deploy_rules_probe.delay(probe.name)
+        deploy_rules_probe.delay(probe.name, force=True)
         messages.add_message(request, messages.SUCCESS, mark_safe(
                              "Deployed rules launched with succeed. " +
                              "<a href='/admin/core/job/'>View Job</a>"))
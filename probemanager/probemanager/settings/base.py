@@ -128,6 +128,77 @@ REST_FRAMEWORK = {
     )
 }
 
+# SSH connection pool (per process)
+SSH_POOL_MAX_SIZE = 100
+SSH_POOL_IDLE_TIMEOUT = 300
+SSH_KEEPALIVE_INTERVAL = 30
+# SSH connections open on the same server, across all the processes. The slot of a connection is renewed while
+# it is used, it expires after SSH_SESSION_LEASE seconds without use or after a crash.
+SSH_MAX_SESSIONS_PER_SERVER = 4
+SSH_SESSION_WAIT_TIMEOUT = 60
+SSH_SESSION_LEASE = 300
+# Fast-fail the SSH operations on a server after repeated connection failures
+SSH_CIRCUIT_FAILURES = 3
+SSH_CIRCUIT_COOLDOWN = 300
+# Timeouts of the SSH connection (connect, banner, authentication), and of a remote command or SFTP operation
+# without answer, in seconds
+SSH_CONNECT_TIMEOUT = 10
+SSH_COMMAND_TIMEOUT = 1800
+# SSH fan-out on several servers at once
+SSH_FAN_OUT_CONCURRENCY = 20
+SSH_FAN_OUT_TIMEOUT = 120
+# SSH streaming of the output of the remote commands
+SSH_STREAM_CHUNK_SIZE = 32768
+SSH_STREAM_POLL_INTERVAL = 1
+SSH_STREAM_TAIL_SIZE = 65536
+# Files smaller than this are always copied entirely
+SSH_DELTA_MIN_SIZE = 65536
+# Streamed output in the result of the jobs
+JOB_RESULT_MAX_SIZE = 1048576
+JOB_RESULT_SAVE_INTERVAL = 2
+# Cached health of the probes, in seconds
+PROBE_STATUS_TTL = 300
+PROBE_STATUS_REFRESH_INTERVAL = 60
+PROBE_HEALTH_RETENTION_DAYS = 90
+# Celery tasks at the same time for a fleet task (run_on_fleet)
+FLEET_CONCURRENCY = 10
+# Rollout of the rules in waves (run_on_fleet with rollout)
+ROLLOUT_CANARY_SIZE = 1
+ROLLOUT_CANARY_TAG = 'canary'
+ROLLOUT_WAVE_SIZE = 10
+ROLLOUT_CONCURRENCY = 5
+ROLLOUT_MAX_FAILURE_RATE = 0.1
+ROLLOUT_PROBE_TIMEOUT = 900
+# Retries of the tasks after a transient error (timeout, connection lost), backoff in seconds
+TASK_MAX_RETRIES = 3
+TASK_RETRY_BACKOFF = 10
+TASK_RETRY_BACKOFF_MAX = 600
+# Jobs older than JOB_RETENTION_DAYS days are moved in the archive files (gzip NDJSON, one per day)
+JOB_RETENTION_DAYS = 30
+JOB_ARCHIVE_DIR = os.path.join(MEDIA_ROOT, 'archives', 'jobs')
+JOB_ARCHIVE_BATCH_SIZE = 1000
+# Configuration kept in each process, in seconds, the changes made by another process are seen after this time
+CONFIGURATION_CACHE_TTL = 60
+# Rows read at a time by the exports of the API
+EXPORT_CHUNK_SIZE = 2000
+# Tasks on the same probe : wait for the task in progress, in seconds, abandoned lock after the timeout
+PROBE_LOCK_WAIT = 60
+PROBE_LOCK_TIMEOUT = 3600
+CELERY_BEAT_SCHEDULE = {
+    'refresh_probes_status': {
+        'task': 'core.tasks.refresh_probes_status',
+        'schedule': PROBE_STATUS_REFRESH_INTERVAL,
+    },
+    'purge_probe_health_samples': {
+        'task': 'core.tasks.purge_probe_health_samples',
+        'schedule': 86400,
+    },
+    'archive_jobs': {
+        'task': 'core.tasks.archive_jobs',
+        'schedule': 86400,
+    },
+}
+
 FIXTURE_DIRS = [BASE_DIR + '/probemanager/fixtures', ]
 
 